@@ -0,0 +1,197 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parsed and cached ARK server INI files (Game.ini, GameUserSettings.ini)"""
+
+import logging
+import os
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+GAME_INI = "Game.ini"
+GAME_USER_SETTINGS = "GameUserSettings.ini"
+
+# Shown by !multipliers even when every map has the same value
+IMPORTANT_MULTIPLIERS = (
+    "MatingIntervalMultiplier",
+    "EggHatchSpeedMultiplier",
+    "BabyMatureSpeedMultiplier",
+    "BabyFoodConsumptionSpeedMultiplier",
+    "LayEggIntervalMultiplier",
+    "BabyCuddleIntervalMultiplier",
+    "BabyCuddleGracePeriodMultiplier",
+    "BabyCuddleLoseImprintQualitySpeedMultiplier",
+    "CropDecaySpeedMultiplier",
+    "HairGrowthSpeedMultiplier",
+    "DinoCountMultiplier",
+    "TamingSpeedMultiplier",
+    "XPMultiplier",
+    "HarvestAmountMultiplier",
+)
+
+
+def server_config_path(server_path, name):
+    """Returns the path of one of a map's INI files, from its server_path in bot.conf"""
+    return os.path.join(server_path, "ShooterGame", "Saved", "Config", "LinuxServer", name)
+
+
+def normalize_value(value):
+    """Returns a setting as it should be compared and shown, ARK writes 2 as 2.000000"""
+    try:
+        return "{:g}".format(float(value))
+    except ValueError:
+        return value
+
+
+def decode_ini(data):
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16", "replace")
+    return data.decode("utf-8-sig", "replace")
+
+
+class IniFile(object):
+    """The settings of one ARK INI file
+
+    We can't use ConfigParser for these, ARK repeats keys (like multiple
+    OverrideNamedEngramEntries) and sections. Every value is kept, in file
+    order, and looked up case insensitively like the game does. Repeated
+    sections are merged. get() returns the first value of a key, get_all()
+    all of them.
+    """
+    def __init__(self, text):
+        # Section name as first written -> [(key, value)] in file order
+        self.sections = OrderedDict()
+        # (section.lower(), key.lower()) -> [values] and key.lower() -> [values] across all sections
+        self._values = {}
+        self._any_section = {}
+        self._section_names = {}
+
+        entries = None
+        section_key = ""
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line[0] in ";#":
+                continue
+            if line[0] == "[" and line[-1] == "]":
+                name = line[1:-1].strip()
+                section_key = name.lower()
+                name = self._section_names.setdefault(section_key, name)
+                entries = self.sections.setdefault(name, [])
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                continue
+            key = key.rstrip()
+            value = value.strip()
+            if entries is None:
+                # Settings before the first section header
+                entries = self.sections.setdefault("", [])
+                self._section_names[""] = ""
+            entries.append((key, value))
+            key_lower = key.lower()
+            self._values.setdefault((section_key, key_lower), []).append(value)
+            self._any_section.setdefault(key_lower, []).append(value)
+
+    def get_all(self, key, section=None):
+        """Returns every value of key, in file order, from section or from any section when it's None"""
+        if section is None:
+            return self._any_section.get(key.lower(), [])
+        return self._values.get((section.lower(), key.lower()), [])
+
+    def get(self, key, section=None, default=None):
+        values = self.get_all(key, section)
+        return values[0] if values else default
+
+    def items(self, section):
+        """Returns [(key, value)] for a section in file order, duplicates included"""
+        name = self._section_names.get(section.lower())
+        return list(self.sections[name]) if name is not None else []
+
+
+class IniCache(object):
+    """Parses each INI file once, and again only when its mtime or size changes
+
+    get() costs a stat() while the file is unchanged, so callers can ask for
+    a map's settings as often as they need instead of keeping their own copy.
+    """
+    def __init__(self):
+        # Path -> (mtime_ns, size, IniFile)
+        self._files = {}
+
+    def get(self, path):
+        """Returns the IniFile for path, raises OSError if it can't be read"""
+        stat = os.stat(path)
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        with open(path, "rb") as ini_file:
+            # Keep the stat from before the read, if the file changes while it's
+            # being read the next get() sees a different one and parses it again
+            stat = os.fstat(ini_file.fileno())
+            data = ini_file.read()
+        ini = IniFile(decode_ini(data))
+        self._files[path] = (stat.st_mtime_ns, stat.st_size, ini)
+        log.debug("Parsed {}".format(path))
+        return ini
+
+    def server_file(self, server_path, name):
+        """Returns the IniFile for one of a map's INI files, see server_config_path()"""
+        return self.get(server_config_path(server_path, name))
+
+
+def multiplier_settings(*ini_files):
+    """Returns OrderedDict of key.lower() -> (key, value) for every multiplier setting in the files
+
+    A key set more than once, or in more than one of the files, keeps its
+    first value, which is the one the game reads.
+    """
+    settings = OrderedDict()
+    for ini in ini_files:
+        for entries in ini.sections.values():
+            for key, value in entries:
+                key_lower = key.lower()
+                if "multiplier" in key_lower and key_lower not in settings:
+                    settings[key_lower] = (key, normalize_value(value))
+    return settings
+
+
+def diff_settings(map_settings):
+    """Compares settings across maps, map_settings is map name -> settings from multiplier_settings()
+
+    Returns (differing, same). differing is [(key, OrderedDict of value -> [map
+    names])] for the keys whose value isn't the same on every map, a value of
+    None meaning the map doesn't set the key. same is [(key, value)] for the
+    rest. Both are sorted by key.
+    """
+    names = {}
+    for settings in map_settings.values():
+        for key_lower, (key, _) in settings.items():
+            names.setdefault(key_lower, key)
+
+    differing = []
+    same = []
+    for key_lower in sorted(names):
+        values = OrderedDict()
+        for map_name, settings in map_settings.items():
+            value = settings.get(key_lower, (None, None))[1]
+            values.setdefault(value, []).append(map_name)
+        if len(values) == 1:
+            same.append((names[key_lower], next(iter(values))))
+        else:
+            differing.append((names[key_lower], values))
+    return differing, same
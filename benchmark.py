@@ -0,0 +1,511 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the RCON/A2S clients and the bot's hot paths
+
+Every benchmark runs against a local FakeArkServer, never a live map.
+
+    python benchmark.py                  # run everything
+    python benchmark.py rcon_async_pipelined --iterations 5000 --latency 0.01
+    python benchmark.py --list
+
+Each benchmark is run once for timing and once more (with fewer iterations)
+under tracemalloc to report the peak memory allocated while it ran.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from arkini import IniCache
+from chat import DEFAULT_CHAT_FILTERS, ChatFilter, decode_chat_buffer
+from chatindex import ChatIndex
+from collections import OrderedDict
+from fakeark import FakeArkServer
+from logwatch import reverse_readline
+from pyarkon import AsyncRCONClient, RCONClient
+from pysteamapi import SteamInfo, SteamQueryEngine, parse_a2s_info, parse_a2s_players, parse_a2s_rules
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Registers a benchmark function
+
+    The function is called as func(iterations, options) and returns a tuple of
+    (total elapsed seconds, list of per-operation latencies in seconds).
+    """
+    def wrapper(func):
+        BENCHMARKS[name] = func
+        return func
+    return wrapper
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[idx]
+
+
+def timed_calls(func, iterations):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_start)
+    return time.perf_counter() - start, latencies
+
+
+def fake_server(options, **kwargs):
+    return FakeArkServer(latency=options.latency, seed=1, **kwargs)
+
+
+@benchmark("rcon_sync")
+def bench_rcon_sync(iterations, options):
+    with fake_server(options) as server:
+        client = RCONClient(server.host, server.rcon_port, server.password)
+        client.connect()
+        result = timed_calls(lambda: client.send_command(command="getchat"), iterations)
+        client.disconnect()
+    return result
+
+
+@benchmark("rcon_sync_large_chunked")
+def bench_rcon_sync_large_chunked(iterations, options):
+    with fake_server(options, chat_lines=200, chunk_size=1024) as server:
+        client = RCONClient(server.host, server.rcon_port, server.password)
+        client.connect()
+        result = timed_calls(lambda: client.send_command(command="getchat"), iterations)
+        client.disconnect()
+    return result
+
+
+async def _async_rcon(server, iterations, concurrency, **kwargs):
+    client = AsyncRCONClient(server.host, server.rcon_port, server.password, **kwargs)
+    await client.connect()
+    latencies = []
+    remaining = [iterations]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            call_start = time.perf_counter()
+            await client.send_command(command="getchat")
+            latencies.append(time.perf_counter() - call_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    await client.disconnect()
+    return elapsed, latencies
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@benchmark("rcon_async_serial")
+def bench_rcon_async_serial(iterations, options):
+    with fake_server(options) as server:
+        return run_async(_async_rcon(server, iterations, options.concurrency, pipelined=False))
+
+
+@benchmark("rcon_async_pipelined")
+def bench_rcon_async_pipelined(iterations, options):
+    with fake_server(options) as server:
+        return run_async(_async_rcon(server, iterations, options.concurrency))
+
+
+@benchmark("a2s_info_sync")
+def bench_a2s_info_sync(iterations, options):
+    with fake_server(options) as server:
+        client = SteamInfo(server.host, server.query_port)
+        result = timed_calls(client.get_a2s_info, iterations)
+        client.close()
+    return result
+
+
+@benchmark("a2s_players_sync")
+def bench_a2s_players_sync(iterations, options):
+    with fake_server(options, player_count=70) as server:
+        client = SteamInfo(server.host, server.query_port)
+        result = timed_calls(client.get_a2s_players, iterations)
+        client.close()
+    return result
+
+
+@benchmark("a2s_rules_sync")
+def bench_a2s_rules_sync(iterations, options):
+    with fake_server(options, mod_count=40) as server:
+        client = SteamInfo(server.host, server.query_port)
+        result = timed_calls(client.get_a2s_rules, iterations)
+        client.close()
+    return result
+
+
+async def _a2s_engine(server, iterations, kinds):
+    engine = SteamQueryEngine(timeout=5)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        await engine.query(server.host, server.query_port, kinds=kinds)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    engine.close()
+    return elapsed, latencies
+
+
+@benchmark("a2s_players_engine")
+def bench_a2s_players_engine(iterations, options):
+    with fake_server(options, player_count=70) as server:
+        return run_async(_a2s_engine(server, iterations, ("A2S_PLAYERS",)))
+
+
+@benchmark("a2s_all_engine")
+def bench_a2s_all_engine(iterations, options):
+    with fake_server(options, player_count=70, mod_count=40) as server:
+        return run_async(_a2s_engine(server, iterations, ("A2S_INFO", "A2S_RULES", "A2S_PLAYERS")))
+
+
+@benchmark("a2s_rules_split_sync")
+def bench_a2s_rules_split_sync(iterations, options):
+    with fake_server(options, mod_count=100, a2s_split_size=1248, a2s_shuffle=True) as server:
+        client = SteamInfo(server.host, server.query_port)
+        result = timed_calls(client.get_a2s_rules, iterations)
+        client.close()
+    return result
+
+
+@benchmark("a2s_rules_split_engine")
+def bench_a2s_rules_split_engine(iterations, options):
+    with fake_server(options, mod_count=100, a2s_split_size=1248, a2s_shuffle=True) as server:
+        return run_async(_a2s_engine(server, iterations, ("A2S_RULES",)))
+
+
+@benchmark("a2s_parse_info")
+def bench_a2s_parse_info(iterations, options):
+    data = FakeArkServer(seed=1).build_a2s_info()
+    return timed_calls(lambda: parse_a2s_info(data), iterations)
+
+
+@benchmark("a2s_parse_rules")
+def bench_a2s_parse_rules(iterations, options):
+    data = FakeArkServer(mod_count=60, seed=1).build_a2s_rules()
+    return timed_calls(lambda: parse_a2s_rules(data), iterations)
+
+
+@benchmark("a2s_parse_players")
+def bench_a2s_parse_players(iterations, options):
+    data = FakeArkServer(player_count=70, seed=1).build_a2s_players()
+    return timed_calls(lambda: parse_a2s_players(data), iterations)
+
+
+def build_chat_buffer(lines=2000):
+    """A large getchat buffer mixing ASCII, accented and CJK/emoji names"""
+    names = ["Survivor", "Dodo Lover", "Jos\u00e9 (Jos\u00e9)", "\u6050\u9f8d (\u6050\u9f8d)", "Rex \U0001f996"]
+    chat = ["{}: message {} with a bit of padding to look like real chat".format(names[idx % len(names)], idx)
+            for idx in range(lines)]
+    return ("\n".join(chat) + "\n").encode("utf8")
+
+
+def legacy_decode_chat_buffer(chat_buffer):
+    """The per-byte loop pull_world_chats used before decode_chat_buffer, kept for comparison"""
+    chats = []
+    current_string = ""
+    for byte in chat_buffer:
+        if byte == 10:  # New line
+            if current_string and current_string.strip():
+                chats.append(current_string)
+            current_string = ""
+        else:
+            if 31 < byte < 127:
+                # ASCII, just convert it
+                current_string += chr(byte)
+            else:
+                # Probably some unicode character, hex escape it
+                current_string += hex(byte).replace("0x", "\\x")
+    return chats
+
+
+@benchmark("chat_decode_legacy")
+def bench_chat_decode_legacy(iterations, options):
+    data = build_chat_buffer()
+    return timed_calls(lambda: legacy_decode_chat_buffer(data), max(iterations // 100, 1))
+
+
+@benchmark("chat_decode")
+def bench_chat_decode(iterations, options):
+    data = build_chat_buffer()
+    return timed_calls(lambda: decode_chat_buffer(data), max(iterations // 100, 1))
+
+
+def legacy_is_filtered(msg):
+    """The chain of checks pull_world_chats used before ChatFilter, kept for comparison"""
+    if msg.startswith(("AdminCmd: ", "SERVER: ", "Command processed")):
+        return True
+    if all(x in msg for x in ["ERROR", "is requested but not installed", "arkmanager"]):
+        return True
+    if all(x in msg for x in ["ERROR", "Your SteamCMD", "not"]):
+        return True
+    if all(x in msg for x in ["ERROR", "You have not rights", "log directory"]):
+        return True
+    if all(x in msg for x in ["Running command", "for instance"]):
+        return True
+    return False
+
+
+def build_filter_lines():
+    lines = decode_chat_buffer(build_chat_buffer(1800))
+    lines += ["AdminCmd: saveworld (PlayerName: Admin, ARKID: 123, SteamID: 456)"] * 100
+    lines += ["Running command 'broadcast' for instance 'theisland'"] * 100
+    return lines
+
+
+@benchmark("chat_filter_legacy")
+def bench_chat_filter_legacy(iterations, options):
+    lines = build_filter_lines()
+    return timed_calls(lambda: [line for line in lines if not legacy_is_filtered(line)], max(iterations // 100, 1))
+
+
+@benchmark("chat_filter")
+def bench_chat_filter(iterations, options):
+    lines = build_filter_lines()
+    chat_filter = ChatFilter(DEFAULT_CHAT_FILTERS)
+    return timed_calls(lambda: [line for line in lines if not chat_filter.is_filtered(line)],
+                       max(iterations // 100, 1))
+
+
+def build_chat_index(path, lines=200000):
+    words = ["rex", "dodo", "base", "raid", "tame", "kibble", "alpha", "trike", "wyvern", "egg", "metal", "cave"]
+    names = ["Survivor (Bob)", "Dodo Lover (Dodo)", "Rex Tamer (Rexy)", "Jos\u00e9 (Jos\u00e9)"]
+    rng = random.Random(1)
+    index = ChatIndex(path)
+    index.open()
+    start = time.time() - lines * 5
+    for idx in range(lines):
+        line = "{}: {}".format(rng.choice(names), " ".join(rng.choice(words) for _ in range(8)))
+        index.add(rng.choice(["theisland", "ragnarok"]), line, start + idx * 5)
+        if idx % 5000 == 4999:
+            index.flush()
+    index.add("ragnarok", "Bob (Bob): who stole my quetzal", start + lines * 2)
+    index.flush()
+    return index
+
+
+@benchmark("chat_index_search")
+def bench_chat_index_search(iterations, options):
+    with tempfile.TemporaryDirectory() as directory:
+        index = build_chat_index(os.path.join(directory, "chat.db"))
+        searches = [
+            {"terms": ["quetzal"]},
+            {"terms": ["wyvern", "egg"], "page": 20},
+            {"player": "jose", "map_name": "ragnarok"},
+            {"terms": ["raid"], "since": time.time() - 30 * 86400, "until": time.time() - 20 * 86400},
+        ]
+        calls = iter(range(iterations))
+        result = timed_calls(lambda: index.search(**searches[next(calls) % len(searches)]), iterations)
+        index.close()
+    return result
+
+
+def legacy_reverse_readline(filename, buf_size=2048):
+    """The str reverse_readline the bot used before logwatch.reverse_readline, kept to compare against"""
+    with open(filename) as fh:
+        segment = None
+        offset = 0
+        fh.seek(0, os.SEEK_END)
+        file_size = remaining_size = fh.tell()
+        while remaining_size > 0:
+            offset = min(file_size, offset + buf_size)
+            fh.seek(file_size - offset)
+            buf = fh.read(min(remaining_size, buf_size))
+            remaining_size -= buf_size
+            lines = buf.split('\n')
+            # the first line of the buffer is probably not a complete line so
+            # we'll save it and append it to the last line of the next buffer
+            # we read
+            if segment is not None:
+                # if the previous chunk starts right from the beginning of line
+                # do not concat the segment to the last line of new chunk
+                # instead, yield the segment first
+                if buf[-1] != '\n':
+                    lines[-1] += segment
+                else:
+                    yield segment
+            segment = lines[0]
+            for index in range(len(lines) - 1, 0, -1):
+                if len(lines[index]):
+                    yield lines[index]
+        # Don't yield None if the file was empty
+        if segment is not None:
+            yield segment
+
+
+def build_server_log(path, size=32 * 1024 * 1024):
+    """Writes an arkserver.log of about size bytes, lines of varied length so they straddle the 2 KiB chunks"""
+    rng = random.Random(2)
+    messages = ["Server: \"Saving world\"", "Player joined", "Tamed a Rex - Lvl 150", "x" * 3000,
+                "Souls (Bob) was killed by a Giganotosaurus - Lvl 224 (Giganotosaurus)!"]
+    written = 0
+    with open(path, "w") as log_file:
+        while written < size:
+            line = "2017.10.18_12.00.00: [theisland] {}\n".format(rng.choice(messages))
+            log_file.write(line)
+            written += len(line)
+
+
+def bench_reverse_readline(iterations, options, reader, tail_lines):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "arkserver.log")
+        build_server_log(path)
+
+        def read():
+            for count, _ in enumerate(reader(path), 1):
+                if count == tail_lines:
+                    break
+
+        return timed_calls(read, iterations)
+
+
+@benchmark("reverse_readline_tail_legacy")
+def bench_reverse_readline_tail_legacy(iterations, options):
+    return bench_reverse_readline(iterations, options, legacy_reverse_readline, 100)
+
+
+@benchmark("reverse_readline_tail")
+def bench_reverse_readline_tail(iterations, options):
+    return bench_reverse_readline(iterations, options, reverse_readline, 100)
+
+
+@benchmark("reverse_readline_full_legacy")
+def bench_reverse_readline_full_legacy(iterations, options):
+    return bench_reverse_readline(max(iterations // 100, 1), options, legacy_reverse_readline, None)
+
+
+@benchmark("reverse_readline_full")
+def bench_reverse_readline_full(iterations, options):
+    return bench_reverse_readline(max(iterations // 100, 1), options, reverse_readline, None)
+
+
+def legacy_get_rcon_info_from_settings(file_path):
+    """The line scan bot.get_rcon_info_from_settings did before arkini.IniCache, kept to compare against"""
+    ret = {"port": None, "password": None}
+    with open(file_path, "r") as settings_file:
+        for line in settings_file:
+            if line.startswith("RCONPort"):
+                ret["port"] = line.split("=")[-1].strip()
+
+            elif line.startswith("ServerAdminPassword"):
+                ret["password"] = line.split("=")[-1].strip()
+
+            if ret["port"] and ret["password"]:
+                return ret
+
+    return {}
+
+
+def build_settings_ini(path, engrams=5000):
+    """Writes a GameUserSettings.ini with a large engram override section ahead of the RCON settings"""
+    with open(path, "w") as ini_file:
+        ini_file.write("[/script/shootergame.shootergamemode]\n")
+        for idx in range(engrams):
+            ini_file.write('OverrideNamedEngramEntries=(EngramClassName="EngramEntry_{}_C",EngramLevelRequirement=1,'
+                           'EngramPointsCost=0,EngramHidden=false)\n'.format(idx))
+        ini_file.write("[ServerSettings]\nXPMultiplier=2.0\nRCONPort=27020\nServerAdminPassword=secret\n")
+
+
+def bench_rcon_settings(iterations, lookup):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "GameUserSettings.ini")
+        build_settings_ini(path)
+        return timed_calls(lambda: lookup(path), iterations)
+
+
+@benchmark("ini_rcon_lookup_legacy")
+def bench_ini_rcon_lookup_legacy(iterations, options):
+    return bench_rcon_settings(iterations, legacy_get_rcon_info_from_settings)
+
+
+@benchmark("ini_rcon_lookup")
+def bench_ini_rcon_lookup(iterations, options):
+    cache = IniCache()
+
+    def lookup(path):
+        settings = cache.get(path)
+        return settings.get("RCONPort"), settings.get("ServerAdminPassword")
+
+    return bench_rcon_settings(iterations, lookup)
+
+
+def run(name, options):
+    func = BENCHMARKS[name]
+    elapsed, latencies = func(options.iterations, options)
+
+    tracemalloc.start()
+    func(max(options.iterations // 10, 1), options)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ops = len(latencies)
+    return {
+        "name": name,
+        "ops": ops,
+        "ops_per_sec": ops / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_kib": peak / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RCON/A2S clients against a local fake server")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run, defaults to all of them")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated server latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent callers for the async clients")
+    parser.add_argument("--list", action="store_true", help="List the available benchmarks")
+    options = parser.parse_args()
+
+    if options.list:
+        print("\n".join(BENCHMARKS))
+        return
+
+    names = options.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmark(s): {}".format(", ".join(unknown)))
+
+    print("{:<28} {:>8} {:>12} {:>10} {:>10} {:>12}".format("benchmark", "ops", "ops/sec", "p50 ms", "p99 ms",
+                                                            "peak KiB"))
+    for name in names:
+        result = run(name, options)
+        print("{name:<28} {ops:>8} {ops_per_sec:>12.1f} {p50_ms:>10.3f} {p99_ms:>10.3f} {peak_kib:>12.1f}".format(
+            **result))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,22 +16,34 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import calendar
 import discord
 import json
 import logging
 import os
 import re
+import sqlite3
 import sys
+import traceback
 
+from arkini import (GAME_INI, GAME_USER_SETTINGS, IMPORTANT_MULTIPLIERS, IniCache, diff_settings, multiplier_settings,
+                    server_config_path)
 from bs4 import BeautifulSoup
+from chat import AdaptivePollInterval, ChatArchive, ChatBatcher, ChatDeduplicator, ChatFilter, decode_chat_buffer
+from chatindex import ChatIndex
+from collections import OrderedDict
 from configparser import ConfigParser
 from discord.ext import commands
+from history import CLUSTER, PlayerHistory
+from logwatch import LogEventDetector, LogTailer, describe_log_line, tail_lines
 from multiprocessing import cpu_count
-from pyarkon import RCONClient
-from pysteamapi import SteamInfo
+from outbound import ALERT, MAX_MESSAGE_LENGTH, OutboundQueue
+from pyarkon import AsyncRCONClient, RCONCluster
+from pysteamapi import SteamQueryEngine
 from requests import get
-from subprocess import PIPE, Popen
-from time import strftime
+from serverstate import ServerSnapshotService
+from subprocess import PIPE, STDOUT, Popen
+from time import gmtime, strftime, strptime, time
 
 __author__ = "ArkAgainstHumanity"
 __version__ = "0.41"
@@ -89,38 +101,52 @@ VERSION = re.compile(" \d{7,9} ")
 PATCH_VERSION = re.compile("^v\d{3,4}\.\d{1,5}$")
 CPU_COUNT = cpu_count()
 
-
-def reverse_readline(filename, buf_size=2048):
-    """a generator that returns the lines of a file in reverse order"""
-    with open(filename) as fh:
-        segment = None
-        offset = 0
-        fh.seek(0, os.SEEK_END)
-        file_size = remaining_size = fh.tell()
-        while remaining_size > 0:
-            offset = min(file_size, offset + buf_size)
-            fh.seek(file_size - offset)
-            buf = fh.read(min(remaining_size, buf_size))
-            remaining_size -= buf_size
-            lines = buf.split('\n')
-            # the first line of the buffer is probably not a complete line so
-            # we'll save it and append it to the last line of the next buffer
-            # we read
-            if segment is not None:
-                # if the previous chunk starts right from the beginning of line
-                # do not concat the segment to the last line of new chunk
-                # instead, yield the segment first
-                if buf[-1] is not '\n':
-                    lines[-1] += segment
-                else:
-                    yield segment
-            segment = lines[0]
-            for index in range(len(lines) - 1, 0, -1):
-                if len(lines[index]):
-                    yield lines[index]
-        # Don't yield None if the file was empty
-        if segment is not None:
-            yield segment
+# Persistent RCON connections, keyed by the map name from the servers section
+rcon_cluster = RCONCluster(timeout=10)
+# A single UDP socket for every A2S query the bot makes
+steam_query = SteamQueryEngine(timeout=5)
+# Latest A2S data for every map, refreshed in the background for the commands to read
+server_state = ServerSnapshotService(
+    steam_query,
+    [(server, (config[server]["server_ip"], int(config[server]["query_port"]))) for server in config["servers"]],
+    interval=config["discord"].getint("state_poll_interval", 30),
+    max_age=config["discord"].getint("state_max_age", 90),
+)
+# Hourly player counts and playtime, recorded from every server_state sweep
+player_history = PlayerHistory(
+    os.path.join(os.getcwd(), "data", "history"),
+    config["servers"],
+    retention_hours=config["discord"].getint("history_days", 186) * 24,
+)
+player_history.load()
+server_state.listeners.append(player_history.record)
+# Compiled [chat_filters] rules per map, for dropping server noise from the chat relay
+chat_filters = dict((server, ChatFilter.from_config(config, server)) for server in config["servers"])
+# Every message the bot sends goes through here, alerts first and chat relay last
+outbound = OutboundQueue(bot)
+# Packs the relayed chat lines into as few Discord messages as possible
+chat_batcher = ChatBatcher(outbound.send_chat, max_delay=config["discord"].getfloat("chat_batch_delay", 2.0))
+# Open chat log per map (None for the maps that don't save their chat), see get_chat_archive
+chat_archives = {}
+# Map name -> asyncio.Event set when players join an empty map, see poll_map_chat
+chat_wakeups = {}
+# Searchable copy of the relayed chat for !searchchat, None when disabled
+chat_index = None
+if config["discord"].get("chat_index", "data/chat_index.db"):
+    chat_index = ChatIndex(os.path.join(os.getcwd(), config["discord"].get("chat_index", "data/chat_index.db")))
+    try:
+        chat_index.open()
+    except sqlite3.Error:
+        log.error("Unable to open the chat index, !searchchat is disabled:\n{}".format(traceback.format_exc()))
+        chat_index = None
+# Compiled [log_events] patterns for watch_server_log
+log_events = LogEventDetector.from_config(config)
+# Parsed Game.ini/GameUserSettings.ini of every map, re-read only when they change
+ini_cache = IniCache()
+# Minutes before a reboot/update at which players get warned in game
+GRACE_PERIOD_WARNINGS = (15, 10, 5, 1)
+# Held for the whole countdown and arkmanager run of !updatemaps/!rebootmaps, so they can't overlap
+maintenance_lock = asyncio.Lock()
 
 
 def remove_html_markup(s):
@@ -143,86 +169,253 @@ def remove_html_markup(s):
 
 
 def get_rcon_info_from_settings(file_path):
-    # We can't use ConfigParser for GameUserSettings.ini in the instances of having
-    # duplicate keys. (Like multiple OverrideNamedEngramEntries)
-    ret = {"port": None, "password": None}
-    with open(file_path, "r") as settings_file:
-        for line in settings_file:
-            if line.startswith("RCONPort"):
-                ret["port"] = line.split("=")[-1].strip()
+    try:
+        settings = ini_cache.get(file_path)
+    except OSError as e:
+        log.error("Unable to read {}: {}".format(file_path, e))
+        return {}
+
+    port = settings.get("RCONPort")
+    password = settings.get("ServerAdminPassword")
+    if port and password:
+        return {"port": port, "password": password}
+    return {}
 
-            elif line.startswith("ServerAdminPassword"):
-                ret["password"] = line.split("=")[-1].strip()
 
-            if ret["port"] and ret["password"]:
-                return ret
+def get_rcon_client(current_map):
+    """Returns the AsyncRCONClient for a map, made again when its RCON port or password change"""
+    game_config_file = server_config_path(config[current_map]["server_path"], GAME_USER_SETTINGS)
+    rcon_info = get_rcon_info_from_settings(game_config_file)
+    client = rcon_cluster.clients.get(current_map)
+    if not rcon_info:
+        if client:
+            # Keep using what worked until the settings can be read again
+            return client
+        log.error("Unable to get RCON Port/Password for {}".format(current_map))
+        return None
 
-    return {}
+    port = int(rcon_info["port"])
+    if client:
+        if (client.port, client.password) == (port, rcon_info["password"]):
+            return client
+        log.info("RCON settings changed for {}, reconnecting".format(current_map))
+        asyncio.ensure_future(client.disconnect())
+
+    client = AsyncRCONClient(config[current_map]["server_ip"], port, rcon_info["password"])
+    rcon_cluster.clients[current_map] = client
+    return client
+
+
+def get_chat_archive(current_map):
+    """Returns the ChatArchive for a map with save_chat=yes or a save_chat_path, or None"""
+    if current_map in chat_archives:
+        return chat_archives[current_map]
+
+    chat_path = config[current_map].get("save_chat_path")
+    if not chat_path and config[current_map].get("save_chat", "no").lower() == "yes":
+        chat_path = os.path.join("log", "{}-chat.txt".format(current_map))
+    if not chat_path:
+        chat_archives[current_map] = None
+        return None
+
+    chat_archives[current_map] = ChatArchive(
+        os.path.join(os.getcwd(), chat_path),
+        max_bytes=int(config["discord"].getfloat("chat_log_max_size", 0) * 1024 * 1024),
+        rotate_daily=config["discord"].getboolean("chat_log_rotate_daily", True),
+        compress=config["discord"].getboolean("chat_log_compress", False),
+    )
+    return chat_archives[current_map]
+
+
+async def reply(ctx, content=None, embed=None):
+    """Replies in the channel a command was issued in, instead of bot.say which bypasses the outbound queue"""
+    return await outbound.send_message(ctx.message.channel, content, embed=embed)
+
+
+async def broadcast_rcon(command, timeout=None):
+    """Sends an RCON command to every configured map at once, returns the per map report"""
+    missing = []
+    for current_map in config["servers"]:
+        if not get_rcon_client(current_map):
+            missing.append(current_map)
+
+    report = await rcon_cluster.broadcast(command, timeout=timeout, names=list(config["servers"]))
+    for current_map in missing:
+        report[current_map] = {"ok": False, "response": None, "error": "no RCON settings found", "elapsed": 0.0}
+    return report
 
 
-async def check_world_crashes():
+def format_broadcast_report(title, report):
+    lines = []
+    for current_map, result in report.items():
+        if result["ok"]:
+            response = result["response"].decode("utf8", "replace").strip()
+            if not response or response.startswith("Server received, But no response"):
+                response = "OK"
+            lines.append("{}: {} ({:.2f}s)".format(current_map, response, result["elapsed"]))
+        else:
+            lines.append("{}: FAILED - {}".format(current_map, result["error"]))
+
+    failed = len([result for result in report.values() if not result["ok"]])
+    summary = "{}: {}/{} maps succeeded".format(title, len(report) - failed, len(report))
+    return "```{}\n\n{}```".format(summary, "\n".join(lines).replace("```", "'''"))
+
+
+async def warn_players(action):
+    """Counts down the grace period in game chat on every map before an action"""
+    schedule = list(GRACE_PERIOD_WARNINGS) + [0]
+    for minutes, next_minutes in zip(schedule, schedule[1:]):
+        await broadcast_rcon("serverchat The server will {} in {} minute(s), please find a safe place to log out."
+                             .format(action, minutes))
+        await asyncio.sleep((minutes - next_minutes) * 60)
+
+    return await broadcast_rcon("saveworld", timeout=60)
+
+
+async def run_arkmanager(*args):
+    proc = await asyncio.create_subprocess_exec("arkmanager", *args, stdout=PIPE, stderr=STDOUT)
+    out, _ = await proc.communicate()
+    return proc.returncode, out.decode("ascii", "ignore").replace("\x0f", "")
+
+
+def get_map_from_channel(channel_name):
+    for current_map in config["servers"]:
+        if config[current_map]["discord_channel"] == channel_name:
+            return current_map
+
+    return None
+
+
+async def alert_log_event(server_object, event, line):
+    description, log_time = describe_log_line(line)
+    embed = discord.Embed(title=event.title, description=description, color=event.color)
+    if log_time:
+        embed.set_footer(text="{} UTC".format(log_time))
+    for channel_name in event.channels:
+        channel_object = discord.utils.get(server_object.channels, name=channel_name)
+        await outbound.send_message(channel_object, embed=embed, priority=ALERT)
+
+
+async def watch_server_log():
     await bot.wait_until_ready()
     await asyncio.sleep(5)
     server_object = discord.utils.get(bot.servers, name=config["discord"]["server_name"])
     if not server_object:
         return None
 
-    last_path = os.path.join(os.getcwd(), "log", "crashlog")
-    crash_path = "/var/log/arktools/arkserver.log"
-    general_chat = discord.utils.get(server_object.channels, name="general")
-    admin_chat = discord.utils.get(server_object.channels, name="admins")
-    while not bot.is_closed:
-        first_run = False
-        if not os.path.exists(last_path):
-            first_run = True
+    server_log = config["discord"]["server_log"]
+    tailer = LogTailer(server_log, os.path.join(os.getcwd(), "log", "crashlog.json"))
+    if tailer.first_run:
+        # Only let people know about the latest of each event, unless we're upgrading from the
+        # old log/crashlog checkpoint which has already done that
+        if not os.path.exists(os.path.join(os.getcwd(), "log", "crashlog")):
+            # Scanning the whole log can take a while on a big one, keep it off the event loop
+            latest = await bot.loop.run_in_executor(None, log_events.backfill, server_log)
+            for event, line in latest.values():
+                await alert_log_event(server_object, event, line)
+        tailer.seek_end()
+        tailer.commit()
 
-        if not first_run:
-            with open(last_path, "r") as lfile:
-                last_message = lfile.read()
-        else:
-            last_message = ""
-
-        next_last_message = ""
-
-        if first_run:
-            ctr = 0
-            for line in reverse_readline(crash_path):
-                if ctr < 1:
-                    next_last_message = line
-                if "Signal 11 caught" in line:
-                    log_time, msg = line.split(": ")
-                    bad_map = msg.split()[0].replace("[", "").replace("]", "")
-                    desc = "{} crashed at {} UTC".format(bad_map, log_time)
-                    embed = discord.Embed(title="Server Crash", description=desc, color=0xff0000)
-                    await bot.send_message(general_chat, embed=embed)
-                    await bot.send_message(admin_chat, embed=embed)
-                    break
-                ctr += 1
-        else:
-            ctr = 0
-            for line in reverse_readline(crash_path):
-                if line == last_message:
-                    break
-                if ctr < 1:
-                    next_last_message = line
-                if "Signal 11 caught" in line:
-                    log_time, msg = line.split(": ")
-                    bad_map = msg.split()[0].replace("[", "").replace("]", "")
-                    desc = "{} crashed at {} UTC".format(bad_map, log_time)
-                    embed = discord.Embed(title="Server Crash", description=desc, color=0xff0000)
-                    await bot.send_message(general_chat, embed=embed)
-                    await bot.send_message(admin_chat, embed=embed)
-                ctr += 1
-
-        if next_last_message:
-            with open(last_path, "w+") as lfile:
-                lfile.write(next_last_message)
+    while not bot.is_closed:
+        # Only the bytes appended since the last check are read
+        data = tailer.read()
+        while data:
+            for event, line in log_events.scan(data):
+                await alert_log_event(server_object, event, line)
+            data = tailer.read()
+        tailer.commit()
 
         await asyncio.sleep(60)
 
     return None
 
 
+def get_player_count(current_map):
+    """Number of players on a map from the latest snapshot, 0 when offline and None when not polled yet"""
+    snapshot = server_state.get(current_map)
+    if not snapshot:
+        return None
+    if not snapshot["online"]:
+        return 0
+    return len(snapshot["A2S_PLAYERS"])
+
+
+def wake_chat_pollers(snapshots):
+    """server_state listener, cuts short the wait of a chat poller once players show up on its map"""
+    for current_map, snapshot in snapshots.items():
+        if current_map in chat_wakeups and snapshot["online"] and snapshot["A2S_PLAYERS"]:
+            chat_wakeups[current_map].set()
+
+
+async def relay_map_chat(current_map, channel_object, deduplicator):
+    """Relays one getchat poll of a map to Discord, returns the number of chat lines it had"""
+    chats = []
+    rcon = get_rcon_client(current_map)
+    if rcon:
+        chats = deduplicator.filter(decode_chat_buffer(await rcon.send_command(command="getchat")))
+    if chats:
+        # Log here so we can log admin commands as well
+        chat_archive = get_chat_archive(current_map)
+        if chat_archive:
+            try:
+                for msg in chats:
+                    chat_archive.write(msg)
+                chat_archive.flush()
+            except OSError:
+                log.error("Unable to write the chat log for {}:\n{}".format(current_map, traceback.format_exc()))
+        for msg in chats:
+            # Ignore the non-chat related server events in the 'getchat' RCON command, see [chat_filters]
+            if chat_filters[current_map].is_filtered(msg):
+                continue
+            if chat_index:
+                chat_index.add(current_map, msg)
+            # Sanitize the message
+            if "```" in msg:
+                msg = msg.replace("```", "'''")
+            # Add a timestamp, the batcher packs the lines into 'pre-blocks' for Discord
+            msg = "{} {}".format(strftime("[%Y/%m/%d %H:%M:%S]"), msg)
+            # Send the chat to discord!
+            await chat_batcher.add(channel_object, msg)
+        if chat_index:
+            try:
+                chat_index.flush()
+            except sqlite3.Error:
+                log.error("Unable to index the chat for {}:\n{}".format(current_map, traceback.format_exc()))
+    return len(chats)
+
+
+async def poll_map_chat(current_map, channel_object):
+    interval = AdaptivePollInterval(
+        min_interval=config["discord"].getfloat("chat_poll_min", 2),
+        max_interval=config["discord"].getfloat("chat_poll_max", 15),
+        empty_interval=config["discord"].getfloat("chat_poll_empty", 60),
+    )
+    wakeup = chat_wakeups[current_map] = asyncio.Event()
+    # Drops lines repeated by a poll that was retried or answered twice
+    deduplicator = ChatDeduplicator()
+    while not bot.is_closed:
+        try:
+            chat_count = await relay_map_chat(current_map, channel_object, deduplicator)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Keep polling, one bad poll shouldn't end the relay for the map
+            log.error("Unable to relay the chat for {}:\n{}".format(current_map, traceback.format_exc()))
+            chat_count = 0
+
+        player_count = get_player_count(current_map)
+        delay = interval.next(chat_count, player_count)
+        if player_count:
+            await asyncio.sleep(delay)
+        else:
+            # Nobody online, but don't sit out the whole delay if somebody joins
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
 async def pull_world_chats():
     await bot.wait_until_ready()
     await asyncio.sleep(5)
@@ -230,80 +423,17 @@ async def pull_world_chats():
     if not server_object:
         return None
 
-    """ Dict structure containing the map name as the key and the value
-        being a Discord object for the channel to store chat logs in.
-    """
-    maps = {}
+    # One poller per map, so a slow or busy map doesn't hold up the others
+    pollers = []
     for current_map in config["servers"]:
-        maps[current_map] = config[current_map]["discord_channel"]
+        channel_object = discord.utils.get(server_object.channels, name=config[current_map]["discord_channel"])
+        pollers.append(poll_map_chat(current_map, channel_object))
+    await asyncio.gather(*pollers)
 
-    while not bot.is_closed:
-        # Iterate the maps and check for new chat messages to send to discord
-        for current_map in maps:
-            chats = []
-            server_base = config[current_map]["server_path"]
-            game_config_file = os.path.join(server_base, "ShooterGame", "Saved", "Config", "LinuxServer",
-                                            "GameUserSettings.ini")
-
-            server_ip = config[current_map]["server_ip"]
-            rcon_info = get_rcon_info_from_settings(game_config_file)
-            if not rcon_info:
-                log.error("Unable to get RCON Port/Password")
-                return False
-            rcon = RCONClient(server_ip, int(rcon_info["port"]), rcon_info["password"])
-            rcon.connect()
-            chat_buffer = rcon.send_command(command="getchat")
-            rcon.disconnect()
-            if chat_buffer:
-                # No chat logs to get!
-                if chat_buffer == b"Server received, But no response!! \n ":
-                    continue
-
-                current_string = ""
-                for byte in chat_buffer:
-                    if byte == 10:  # New line
-                        if current_string and current_string.strip():
-                            chats.append(current_string)
-                        current_string = ""
-                    else:
-                        if 31 < byte < 127:
-                            # ASCII, just convert it
-                            current_string += chr(byte)
-                        else:
-                            # Probably some unicode character, hex escape it
-                            current_string += hex(byte).replace("0x", "\\x")
-            if chats:
-                for msg in chats:
-                    chat_log = config[current_map]["save_chat"]
-                    # Log here so we can log admin commands as well
-                    if chat_log and chat_log.lower() == "yes":
-                        chat_base_path = os.path.join(os.getcwd(), "log")
-                        os.makedirs(chat_base_path, exist_ok=True)
-                        out_file = os.path.join(chat_base_path, "{}-chat.txt".format(current_map))
-                        with open(out_file, "a+") as chat_log_file:
-                            chat_log_file.write("{} {}\n".format(strftime("[%Y/%m/%d %H:%M:%S]"), msg))
-                    # Ignore a bunch of non-chat related server events in the 'getchat' RCON command
-                    if msg.startswith(("AdminCmd: ", "SERVER: ", "Command processed")):
-                        continue
-                    if all(x in msg for x in ["ERROR", "is requested but not installed", "arkmanager"]):
-                        continue
-                    if all(x in msg for x in ["ERROR", "Your SteamCMD", "not"]):
-                        continue
-                    if all(x in msg for x in ["ERROR", "You have not rights", "log directory"]):
-                        continue
-                    if all(x in msg for x in ["Running command", "for instance"]):
-                        continue
-                    # Sanitize the message
-                    if "```" in msg:
-                        msg = msg.replace("```", "'''")
-                    # Add a timestamp, and convert the message to a 'pre-block' for Discord
-                    msg = "```{} {}```".format(strftime("[%Y/%m/%d %H:%M:%S]"), msg)
-                    # Send the chat to discord!
-                    channel_name = config[current_map]["discord_channel"]
-                    channel_object = discord.utils.get(server_object.channels, name=channel_name)
-                    await bot.send_message(channel_object, msg)
-
-        await asyncio.sleep(15)
+
+async def poll_server_state():
+    await bot.wait_until_ready()
+    await server_state.run(is_closed=lambda: bot.is_closed)
 
 
 async def check_new_patch_notes():
@@ -350,7 +480,7 @@ async def check_new_patch_notes():
                         version = tmp
                     if output:
                         output = "```\n" + output.replace("\n\n", "\n").strip() + "\n```"
-                        await bot.send_message(channel_object, output)
+                        await outbound.send_message(channel_object, output)
                     if not start_parse:
                         start_parse = True
                     if start_parse:
@@ -394,7 +524,7 @@ async def checkupdate(ctx):
             if str(member.id) in admin_ids:
                 admins.append(member.mention)
     # Check for updates
-    msg = await bot.say("Checking for update...")
+    msg = await reply(ctx, "Checking for update...")
     p = Popen(["arkmanager", "checkupdate", "@theisland"], stdout=PIPE)
     out = p.stdout.read()
     outputs = str(out).split("\\n")
@@ -406,7 +536,7 @@ async def checkupdate(ctx):
     else:
         output = "Current Version:{0}\nAvailable Version:{1}\n{2}".format(current[0], available[0], outputs[4])
 
-    await bot.edit_message(msg, "Checking for update...\n" + output)
+    await outbound.edit_message(msg, "Checking for update...\n" + output)
     return None
 
 
@@ -421,12 +551,12 @@ async def online(ctx):
         query_port = int(config[server]["query_port"])
         ports[query_port] = server
 
+    snapshots = await server_state.get_fresh()
     _online = {}
     total = 0
     for port in ports:
-        conn = SteamInfo("142.44.142.79", port)
         players = {}
-        online_players = conn.get_a2s_players()
+        online_players = snapshots[ports[port]]["A2S_PLAYERS"]
         for player in online_players:
             if player["player_name"]:
                 total += 1
@@ -442,53 +572,154 @@ async def online(ctx):
             h, m = divmod(m, 60)
             out += "\n  *{}* has been online for: {}h {}m {}s".format(_online[port][player], h, m, s)
 
-    await bot.say(out)
+    await reply(ctx, out)
     return None
 
 
 @bot.command(pass_context=True)
-async def multipliers(ctx):
+async def peak(ctx):
     channel = str(ctx.message.channel.name)
     if channel not in ["admins", "bot_commands"]:
         return None
 
-    important_multipliers = (
-        "MatingIntervalMultiplier",
-        "EggHatchSpeedMultiplier",
-        "BabyMatureSpeedMultiplier",
-        "BabyFoodConsumptionSpeedMultiplier",
-        "LayEggIntervalMultiplier",
-        "BabyCuddleIntervalMultiplier",
-        "BabyCuddleGracePeriodMultiplier",
-        "BabyCuddleLoseImprintQualitySpeedMultiplier",
-        "CropDecaySpeedMultiplier",
-        "HairGrowthSpeedMultiplier",
-        "DinoCountMultiplier",
-        "TamingSpeedMultiplier",
-        "XPMultiplier",
-        "HarvestAmountMultiplier",
-    )
+    now = time()
+    out = "```{:<16} {:>8} {:>8}   {}\n".format("Map", "24h", "All-time", "All-time peak on (UTC)")
+    for server in list(config["servers"]) + [CLUSTER]:
+        history = player_history.maps[server]
+        day_peak, _ = history.peak_since(now - 24 * 3600, now)
+        peak_date = strftime("%Y/%m/%d %H:%M", gmtime(history.peak_time)) if history.peak_time else "-"
+        out += "{:<16} {:>8} {:>8}   {}\n".format(server, day_peak, history.peak, peak_date)
+    out += "```"
 
-    gameini = "/home/ark/arkservers/theisland/ShooterGame/Saved/Config/LinuxServer/Game.ini"
-    with open(gameini, "r") as gamefile:
-        data = gamefile.read()
+    await reply(ctx, out)
+    return None
 
-    lines = []
-    if data:
-        for line in data.splitlines():
-            if line.startswith(important_multipliers):
-                lines.append(line)
 
-    gameini = "/home/ark/arkservers/theisland/ShooterGame/Saved/Config/LinuxServer/GameUserSettings.ini"
-    with open(gameini, "r") as gamefile:
-        data = gamefile.read()
+@bot.command(pass_context=True)
+async def history(ctx, *args):
+    channel = str(ctx.message.channel.name)
+    if channel not in ["admins", "bot_commands"]:
+        return None
 
-    if data:
-        for line in data.splitlines():
-            if line.startswith(important_multipliers):
-                lines.append(line)
-    out = "```python\n{}\n```".format("\n".join(lines))
-    await bot.say(out)
+    server = args[0].lower() if args else CLUSTER
+    if server not in player_history.maps:
+        await reply(ctx, "Unknown map {}, try one of: {}".format(server, ", ".join(player_history.maps)))
+        return None
+
+    now = time()
+    map_history = player_history.maps[server]
+    out = "```{} - peak players per hour (UTC)\n".format(server)
+    for hour_start, hour_peak, _ in map_history.hourly(now, 24):
+        if hour_peak is None:
+            out += "{}  -\n".format(strftime("%H:00", gmtime(hour_start)))
+        else:
+            out += "{}  {} {}\n".format(strftime("%H:00", gmtime(hour_start)), "#" * min(hour_peak, 40), hour_peak)
+
+    out += "\nLast 7 days\n"
+    for day_start, day_peak, day_average in map_history.daily(now, 7):
+        if day_peak is None:
+            out += "{}  no data\n".format(strftime("%Y/%m/%d", gmtime(day_start)))
+        else:
+            out += "{}  peak {:>3}  average {:.1f}\n".format(strftime("%Y/%m/%d", gmtime(day_start)), day_peak,
+                                                             day_average)
+    out += "```"
+
+    await reply(ctx, out)
+    return None
+
+
+@bot.command(pass_context=True)
+async def playtime(ctx):
+    channel = str(ctx.message.channel.name)
+    if channel not in ["admins", "bot_commands"]:
+        return None
+
+    leaders = player_history.leaderboard(10)
+    if not leaders:
+        await reply(ctx, "No playtime has been recorded yet")
+        return None
+
+    out = "__**Most time online:**__"
+    for rank, (name, seconds, sessions) in enumerate(leaders, 1):
+        m, s = divmod(int(seconds), 60)
+        h, m = divmod(m, 60)
+        out += "\n  {}. *{}* {}h {}m over {} sessions".format(rank, name, h, m, sessions)
+
+    await reply(ctx, out)
+    return None
+
+
+def get_map_multipliers(current_map):
+    """Returns the multiplier settings of a map from its cached INI files, None if neither can be read"""
+    ini_files = []
+    for name in (GAME_INI, GAME_USER_SETTINGS):
+        try:
+            ini_files.append(ini_cache.server_file(config[current_map]["server_path"], name))
+        except OSError as e:
+            log.error("Unable to read {} for {}: {}".format(name, current_map, e))
+    return multiplier_settings(*ini_files) if ini_files else None
+
+
+def format_settings_block(lines):
+    """Returns lines as a python code block, cut short to fit in one Discord message"""
+    out = "```python\n"
+    for line in lines:
+        if len(out) + len(line) + 20 > MAX_MESSAGE_LENGTH:
+            out += "# ...\n"
+            break
+        out += line + "\n"
+    return out + "```"
+
+
+@bot.command(pass_context=True)
+async def multipliers(ctx, *args):
+    channel = str(ctx.message.channel.name)
+    if channel not in ["admins", "bot_commands"]:
+        return None
+
+    maps = list(config["servers"])
+    if args:
+        server = args[0].lower()
+        if server not in maps:
+            await reply(ctx, "Unknown map {}, try one of: {}".format(server, ", ".join(maps)))
+            return None
+        settings = get_map_multipliers(server)
+        if settings is None:
+            await reply(ctx, "Unable to read the settings for {}".format(server))
+            return None
+        lines = ["# {}".format(server)]
+        lines.extend("{}={}".format(key, value) for key, value in sorted(settings.values()))
+        await reply(ctx, format_settings_block(lines))
+        return None
+
+    map_settings = OrderedDict()
+    unreadable = []
+    for server in maps:
+        settings = get_map_multipliers(server)
+        if settings is None:
+            unreadable.append(server)
+        else:
+            map_settings[server] = settings
+    if not map_settings:
+        await reply(ctx, "Unable to read the settings for any map")
+        return None
+
+    differing, same = diff_settings(map_settings)
+    important = set(name.lower() for name in IMPORTANT_MULTIPLIERS)
+    lines = []
+    if differing:
+        lines.append("# Different between maps (!multipliers mapname shows all of a map's)")
+        for key, values in differing:
+            lines.append(key)
+            for value, value_maps in values.items():
+                lines.append("    {}: {}".format("not set" if value is None else value, ", ".join(value_maps)))
+    same = [(key, value) for key, value in same if key.lower() in important]
+    if same:
+        lines.append("# The same on every map" if len(map_settings) > 1 else "# {}".format(next(iter(map_settings))))
+        lines.extend("{}={}".format(key, value) for key, value in same)
+    if unreadable:
+        lines.append("# Unable to read the settings for {}".format(", ".join(unreadable)))
+    await reply(ctx, format_settings_block(lines))
     return None
 
 
@@ -502,7 +733,7 @@ async def events(ctx):
         data = efile.read()
 
     if data:
-        await bot.say(data)
+        await reply(ctx, data)
 
     return None
 
@@ -561,7 +792,7 @@ async def performance(ctx):
                                          aberrationmem, crystalmem)
         )
         output += "\n```"
-        await bot.say(output)
+        await reply(ctx, output)
 
     return None
 
@@ -576,7 +807,7 @@ async def vote(ctx):
         "ARK-Servers: (Vote requires steam login)\n"
         "    <https://ark-servers.net/group/295/>"
     )
-    await bot.say(out)
+    await reply(ctx, out)
     return None
 
 
@@ -602,7 +833,7 @@ async def mods(ctx):
         "Iso: Crystal Isles (Map, optional): "
         "<https://steamcommunity.com/sharedfiles/filedetails/changelog/804312798>"
     )
-    await bot.say(out)
+    await reply(ctx, out)
     return None
 
 
@@ -623,7 +854,7 @@ async def getarkname(ctx):
         output = "{}: Your ARK chat name is {}.".format(user_name, jdata[user_id]["name"])
     else:
         output = "{}: You have not set an ARK chat name. Use !setarkname your_name to set one.".format(user_name)
-    await bot.say(output)
+    await reply(ctx, output)
 
     return None
 
@@ -636,13 +867,12 @@ async def setarkname(ctx, *args):
         return None
 
     if len(args) > 1:
-        await bot.say("{}: Looks like you have some spaces in your name, or tried to give me more than one :)".format(
-            user_name
-        ))
+        await reply(ctx, "{}: Looks like you have some spaces in your name, or tried to give me more than one "
+                         ":)".format(user_name))
         return None
 
     if len(args) == 0:
-        await bot.say("{}: Looks like you forgot to give me a name :)".format(user_name))
+        await reply(ctx, "{}: Looks like you forgot to give me a name :)".format(user_name))
         return None
 
     user_id = str(ctx.message.author.id)
@@ -666,7 +896,7 @@ async def setarkname(ctx, *args):
             output = "Sorry {}, the name {} is invalid due to the following characters: {}".format(
                 ctx.message.author.name, name, ", ".join(bad_chars)
             )
-        await bot.say(output)
+        await reply(ctx, output)
         return None
 
     user_file = os.path.join(os.getcwd(), "data", "users.json")
@@ -676,24 +906,24 @@ async def setarkname(ctx, *args):
     jdata = json.loads(data)
     if user_id not in jdata:
         jdata[user_id] = {"name": name, "changes": 1}
-        await bot.say("{}: Your ARK chat name has been set to {}. You can change this 1 time in the future "
-                      "using this command.".format(user_name, name))
+        await reply(ctx, "{}: Your ARK chat name has been set to {}. You can change this 1 time in the future "
+                    "using this command.".format(user_name, name))
         with open(user_file, "w") as ufile:
             ufile.write(json.dumps(jdata))
         return None
 
     if jdata[user_id]["changes"] == 0:
-        await bot.say("{}: You are not allowed to change your ARK chat name anymore".format(user_name))
+        await reply(ctx, "{}: You are not allowed to change your ARK chat name anymore".format(user_name))
         return None
 
     old_name = jdata[user_id]["name"]
     if old_name == name:
-        await bot.say("{}: You can't change your name if it's the same!".format(user_name))
+        await reply(ctx, "{}: You can't change your name if it's the same!".format(user_name))
         return None
 
     jdata[user_id]["name"] = name
     jdata[user_id]["changes"] -= 1
-    await bot.say("{}: You have changed your name from {} to {}.".format(user_name, old_name, name))
+    await reply(ctx, "{}: You have changed your name from {} to {}.".format(user_name, old_name, name))
     with open(user_file, "w") as ufile:
         ufile.write(json.dumps(jdata))
     return None
@@ -707,7 +937,7 @@ async def say(ctx, *args):
 
     out = " ".join(list(args))
     if "\\" in out or "\"" in out:
-        await bot.say("Unable to send message as a restricted character was observed (\", \\)")
+        await reply(ctx, "Unable to send message as a restricted character was observed (\", \\)")
         return None
 
     user_file = os.path.join(os.getcwd(), "data", "users.json")
@@ -718,18 +948,22 @@ async def say(ctx, *args):
     user_name = str(ctx.message.author.name)
     user_id = str(ctx.message.author.id)
     if user_id not in jdata:
-        await bot.say("{}: You have not set your ARK chat name. Do so by issuing a !setarkname your_name command "
-                      "in the bot_commands channel.".format(user_name))
+        await reply(ctx, "{}: You have not set your ARK chat name. Do so by issuing a !setarkname your_name command "
+                    "in the bot_commands channel.".format(user_name))
+        return None
+
+    current_map = get_map_from_channel(channel)
+    rcon = get_rcon_client(current_map) if current_map else None
+    if not rcon:
+        await reply(ctx, "Unable to find the RCON settings for this channel's server")
+        return None
 
     name = jdata[user_id]["name"]
-    server = "@{}".format(channel.replace("server_", ""))
-    msg = "\"serverchat {}: {}\"".format(name, out)
-    p = Popen(["arkmanager rconcmd {} {}".format(msg, server)], stdout=PIPE, shell=True)
-    out = p.stdout.read().decode("ascii")
-    if "Command processed" in out:
+    resp = await rcon.send_command(command="serverchat {}: {}".format(name, out))
+    if resp is not None:
         await bot.add_reaction(ctx.message, "\U0001F44C")
     else:
-        await bot.say("Unknown output: {}".format(out))
+        await reply(ctx, "Unable to reach the server, message was not sent")
     return None
 
 
@@ -739,36 +973,20 @@ async def status(ctx):
     if channel not in ["admins", "bot_commands"]:
         return None
 
-    p = Popen(["arkmanager", "status", "@all"], stdout=PIPE)
-    out = p.stdout.read().decode("ascii", "ignore").replace("\x0f", "")
-    current = ""
-    running = ""
-    listening = ""
-    servers = {}
-    for line in out.splitlines():
-        if "Running command" in line:
-            current = line.split("'")[3]
-        elif "Server running" in line:
-            running = line.split(":")[1].split()[1]
-        elif "Server listening" in line:
-            listening = line.split(":")[1].split()[1]
-        if current and running and listening:
-            if running == "Yes" and listening == "Yes":
-                servers[current] = discord.Embed(title=current, description="Server is online", color=0x00ff00)
-            elif running == "Yes" and listening == "No":
-                servers[current] = discord.Embed(title=current, description="Server is still booting", color=0xffff00)
-            elif running == "No" and listening == "No":
-                servers[current] = discord.Embed(title=current, description="Server is offline", color=0xff0000)
-            current = ""
-            running = ""
-            listening = ""
-
+    snapshots = await server_state.get_fresh()
     # Display server embeds in the same order in which we update
-    await bot.say(embed=servers["theisland"])
-    await bot.say(embed=servers["thecenter"])
-    await bot.say(embed=servers["scorched"])
-    await bot.say(embed=servers["ragnarok"])
-    await bot.say(embed=servers["crystalisles"])
+    for server, snapshot in snapshots.items():
+        if snapshot["online"]:
+            info = snapshot["A2S_INFO"]
+            desc = "Server is online\nPlayers: {}\nVersion: {}".format(info["players"], info["server_version"])
+            embed = discord.Embed(title=server, description=desc, color=0x00ff00)
+        elif snapshot["last_seen"]:
+            desc = "Server is offline or still booting\nLast seen: {} UTC".format(
+                strftime("%Y/%m/%d %H:%M:%S", gmtime(snapshot["last_seen"])))
+            embed = discord.Embed(title=server, description=desc, color=0xff0000)
+        else:
+            embed = discord.Embed(title=server, description="Server is offline or still booting", color=0xff0000)
+        await reply(ctx, embed=embed)
 
     return None
 
@@ -779,7 +997,20 @@ async def updatemaps(ctx):
     if channel != "admins":
         return None
 
-    await bot.say("Command not implemented yet")
+    if maintenance_lock.locked():
+        await reply(ctx, "An update or reboot is already in progress")
+        return None
+
+    async with maintenance_lock:
+        await reply(ctx, "Updating all maps in {} minutes, players are being warned in game".format(
+            GRACE_PERIOD_WARNINGS[0]))
+        report = await warn_players("update and restart")
+        await reply(ctx, format_broadcast_report("saveworld", report))
+        returncode, out = await run_arkmanager("update", "--update-mods", "@all")
+        if returncode:
+            await reply(ctx, "arkmanager update failed ({}):\n```{}```".format(returncode, out[-1800:]))
+        else:
+            await reply(ctx, "Update finished, maps that had an ARK or mod update are restarting")
     return None
 
 
@@ -789,17 +1020,36 @@ async def rebootmaps(ctx):
     if channel != "admins":
         return None
 
-    await bot.say("Command not implemented yet")
+    if maintenance_lock.locked():
+        await reply(ctx, "An update or reboot is already in progress")
+        return None
+
+    async with maintenance_lock:
+        await reply(ctx, "Rebooting all maps in {} minutes, players are being warned in game".format(
+            GRACE_PERIOD_WARNINGS[0]))
+        report = await warn_players("restart")
+        await reply(ctx, format_broadcast_report("saveworld", report))
+        returncode, out = await run_arkmanager("restart", "@all")
+        if returncode:
+            await reply(ctx, "arkmanager restart failed ({}):\n```{}```".format(returncode, out[-1800:]))
+        else:
+            await reply(ctx, "All maps are restarting")
     return None
 
 
 @bot.command(pass_context=True)
-async def setmotd(ctx):
+async def setmotd(ctx, *args):
     channel = str(ctx.message.channel.name)
     if channel != "admins":
         return None
 
-    await bot.say("Command not implemented yet")
+    motd = " ".join(args)
+    if not motd:
+        await reply(ctx, "Looks like you forgot to give me a message of the day :)")
+        return None
+
+    report = await broadcast_rcon("SetMessageOfTheDay {}".format(motd))
+    await reply(ctx, format_broadcast_report("SetMessageOfTheDay", report))
     return None
 
 
@@ -809,7 +1059,116 @@ async def showmotd(ctx):
     if channel != "admins":
         return None
 
-    await bot.say("Command not implemented yet")
+    report = await broadcast_rcon("ShowMessageOfTheDay")
+    await reply(ctx, format_broadcast_report("ShowMessageOfTheDay", report))
+    return None
+
+
+def parse_search_time(value, end_of_day=False):
+    """Parses 30m/12h/7d/2w as that long ago, or a YYYY-MM-DD (UTC) date, returns unix time or None"""
+    match = re.match(r"^(\d+)([mhdw])$", value)
+    if match:
+        units = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+        return time() - int(match.group(1)) * units[match.group(2)]
+    for date_format in ("%Y-%m-%d", "%Y/%m/%d"):
+        try:
+            timestamp = calendar.timegm(strptime(value, date_format))
+        except ValueError:
+            continue
+        return timestamp + 86399 if end_of_day else timestamp
+    return None
+
+
+@bot.command(pass_context=True)
+async def searchchat(ctx, *args):
+    channel = str(ctx.message.channel.name)
+    if channel != "admins":
+        return None
+    if not chat_index:
+        await reply(ctx, "The chat index is disabled")
+        return None
+
+    terms = []
+    options = {"map": None, "player": None, "since": None, "until": None, "page": "1"}
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        if sep and key.lower() in options and value:
+            options[key.lower()] = value
+        else:
+            terms.append(arg)
+
+    since = until = None
+    if options["since"]:
+        since = parse_search_time(options["since"])
+    if options["until"]:
+        until = parse_search_time(options["until"], end_of_day=True)
+    if (options["since"] and since is None) or (options["until"] and until is None):
+        await reply(ctx, "Times look like 30m, 12h, 7d, 2w or 2017-12-31")
+        return None
+    if not options["page"].isdigit():
+        await reply(ctx, "The page has to be a number")
+        return None
+    page = max(int(options["page"]), 1)
+    if not terms and not options["player"] and since is None and until is None and not options["map"]:
+        await reply(ctx, "Give me something to search for, like !searchchat raid map:theisland player:name since:7d")
+        return None
+
+    # Map names are the lowercase [servers] keys, like !history takes them
+    map_name = options["map"].lower() if options["map"] else None
+    rows, more = chat_index.search(terms=terms, player=options["player"], map_name=map_name, since=since,
+                                   until=until, page=page)
+    if not rows:
+        await reply(ctx, "No chat found" if page == 1 else "No more chat found")
+        return None
+
+    out = "```Page {} (UTC, newest first)\n\n".format(page)
+    for map_name, timestamp, player, text in rows:
+        line = "[{}] {} {}{}".format(strftime("%Y/%m/%d %H:%M:%S", gmtime(timestamp)), map_name,
+                                     player + ": " if player else "", text)
+        out += line[:180].replace("```", "'''") + "\n"
+    if more:
+        out += "\nMore results with page:{}".format(page + 1)
+    out += "```"
+    await reply(ctx, out)
+    return None
+
+
+@bot.command(pass_context=True)
+async def serverlog(ctx, *args):
+    channel = str(ctx.message.channel.name)
+    if channel != "admins":
+        return None
+
+    count = 10
+    server = None
+    for arg in args:
+        if arg.isdigit():
+            count = min(int(arg), 50)
+        else:
+            server = arg.lower()
+    if server and server not in config["servers"]:
+        await reply(ctx, "Unknown map {}, try one of: {}".format(server, ", ".join(config["servers"])))
+        return None
+
+    server_log = config["discord"]["server_log"]
+    try:
+        # A map that hasn't logged in a while means reading far back, keep it off the event loop
+        lines = await bot.loop.run_in_executor(None, tail_lines, server_log, count, server)
+    except OSError as e:
+        await reply(ctx, "Unable to read {}: {}".format(server_log, e))
+        return None
+    if not lines:
+        await reply(ctx, "Nothing in the server log" + (" for {}".format(server) if server else ""))
+        return None
+
+    # Newest lines matter most, so drop the oldest ones to fit in one message
+    out = ""
+    for line in reversed(lines):
+        line = line[:300].replace("```", "'''") + "\n"
+        if len(out) + len(line) + 10 > MAX_MESSAGE_LENGTH:
+            break
+        out = line + out
+    await reply(ctx, "```{}```".format(out))
     return None
 
 
@@ -824,7 +1183,10 @@ async def help(ctx):
         "!help          Shows this prompt\n"
         "!checkupdate   Checks for an update to the ARK server/maps (not mods)\n"
         "!online        Show who's online and on which server\n"
-        "!multipliers   Show AAH's default configured multipliers\n"
+        "!peak          Show the most players online per map, all-time and in the last 24 hours\n"
+        "!history       Show player counts over the last day and week (!history mapname)\n"
+        "!playtime      Show the players with the most time online\n"
+        "!multipliers   Show the multipliers that differ between maps (!multipliers mapname for one map)\n"
         "!mods          Show links to mod changelog\n"
         "!events        Show any upcoming event(s)\n"
         "!performance   Check if you are crashing the server...\n"
@@ -836,22 +1198,28 @@ async def help(ctx):
         "\nPing us if you have any feature requests!\n"
         "```"
     )
-    await bot.say(out)
+    await reply(ctx, out)
 
     if channel == "admins":
         out = (
             "```Admin Commands:\n"
             "!updatemaps   Runs a full update (ARK and Mods) for all maps. 15 minute grace period to log out\n"
             "!rebootmaps   Reboots all of the maps. 15 minute grace period to log out\n"
-            "!setmotd      Sets the message of the day on all maps\n"
+            "!setmotd      Sets the message of the day on all maps (!setmotd your message)\n"
             "!showmotd     Shows the message of the dat on all maps\n"
+            "!searchchat   Searches the relayed chat, newest first (!searchchat words map:theisland "
+            "player:name since:7d until:2017-12-31 page:2)\n"
+            "!serverlog    Shows the end of the server log (!serverlog 20 theisland)\n"
             "```"
         )
-        await bot.say(out)
+        await reply(ctx, out)
 
     return None
 
+server_state.listeners.append(wake_chat_pollers)
+bot.loop.create_task(outbound.run(is_closed=lambda: bot.is_closed))
+bot.loop.create_task(poll_server_state())
 bot.loop.create_task(pull_world_chats())
-bot.loop.create_task(check_world_crashes())
+bot.loop.create_task(watch_server_log())
 bot.loop.create_task(check_new_patch_notes())
 bot.run(config["discord"]["apikey"])
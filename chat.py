@@ -0,0 +1,434 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Turning RCON getchat buffers into chat lines for Discord"""
+
+import asyncio
+import gzip
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+NO_CHAT = b"Server received, But no response!! \n "
+
+# Tabs become spaces, every other ASCII control character except the newline is dropped.
+# Bytes below 0x80 never appear inside a multi-byte UTF-8 sequence, so this is safe
+# to run on the raw buffer before decoding.
+CONTROL_TABLE = bytes.maketrans(b"\t", b" ")
+CONTROL_BYTES = bytes(byte for byte in range(32) if byte not in (9, 10)) + b"\x7f"
+
+
+def decode_chat_buffer(chat_buffer):
+    """Returns the non-blank lines of a getchat response as str
+
+    The whole buffer is cleaned with a single bytes.translate, split with
+    bytes.split and each line decoded as UTF-8, invalid sequences becoming
+    U+FFFD instead of breaking the line.
+    """
+    if not chat_buffer or chat_buffer == NO_CHAT:
+        return []
+    cleaned = chat_buffer.translate(CONTROL_TABLE, CONTROL_BYTES)
+    return [line.decode("utf-8", "replace") for line in cleaned.split(b"\n") if line.strip()]
+
+
+# Used when bot.conf has no [chat_filters] section, the arkmanager/server noise the
+# getchat command mixes in with the player chat
+DEFAULT_CHAT_FILTERS = OrderedDict([
+    ("prefix.server_events", "AdminCmd:, SERVER:, Command processed"),
+    ("contains.arkmanager_missing", "ERROR, is requested but not installed, arkmanager"),
+    ("contains.steamcmd", "ERROR, Your SteamCMD, not"),
+    ("contains.log_rights", "ERROR, You have not rights, log directory"),
+    ("contains.running_command", "Running command, for instance"),
+])
+
+GLOBAL_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+
+
+class ChatFilter(object):
+    """Classifies chat lines against a set of named filter rules
+
+    Rules are configured as "<kind>.<name> = <value>":
+
+        prefix.<name>    the line starts with any of the comma separated values
+        contains.<name>  the line contains every one of the comma separated values
+        regex.<name>     the regular expression matches anywhere in the line
+
+    The prefix and regex rules are compiled into one alternation anchored at
+    the start of the line, with a named group per rule so match.lastgroup says
+    which rule hit. The terms of every contains rule are compiled into one
+    more alternation of literals that is searched once per line; only when it
+    finds one of them are the contains rules checked in full.
+    Most chat lines contain none of the terms, so each line costs one anchored
+    match and one scan no matter how many rules are configured.
+
+    A regex rule starting with flags like (?i) is the exception and gets a
+    pattern of its own, searched separately. Inside the alternation its
+    flags would apply to every rule, and scoped (?i:...) groups need
+    Python 3.6.
+    """
+    KINDS = ("prefix", "contains", "regex")
+
+    def __init__(self, rules=None):
+        # Rule name -> (kind, value)
+        self.rules = OrderedDict()
+        groups = []
+        self._group_names = []
+        # Position of each group's rule among the prefix/regex rules, which decides which rule wins
+        self._group_ranks = []
+        # (rank, rule name, compiled pattern) for the regex rules with flags
+        self._flagged = []
+        rank = 0
+        # (rule name, terms) for the contains rules
+        self._contains = []
+        for key, value in (rules or {}).items():
+            kind, _, name = key.partition(".")
+            value = value.strip()
+            if not value:
+                # An empty value disables the rule, used by per map overrides
+                continue
+            if kind not in self.KINDS or not name:
+                raise ValueError("Unknown chat filter {}, expected prefix.<name>, contains.<name> or "
+                                 "regex.<name>".format(key))
+            self.rules[name] = (kind, value)
+
+            terms = [term.strip() for term in value.split(",") if term.strip()]
+            if kind == "contains":
+                self._contains.append((name, terms))
+                continue
+
+            if kind == "prefix":
+                pattern = "|".join(re.escape(term) for term in terms)
+            else:
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    raise ValueError("Invalid regex for chat filter {}: {}".format(key, e))
+                if GLOBAL_FLAGS.match(value):
+                    self._flagged.append((rank, name, re.compile(value, re.DOTALL)))
+                    rank += 1
+                    continue
+                pattern = ".*?(?:{})".format(value)
+            # Rule names come from the config, so give the groups safe names of our own
+            groups.append("(?P<rule{}>{})".format(len(self._group_names), pattern))
+            self._group_names.append(name)
+            self._group_ranks.append(rank)
+            rank += 1
+
+        try:
+            self._pattern = re.compile("|".join(groups), re.DOTALL) if groups else None
+        except re.error as e:
+            raise ValueError("Unable to combine the chat filters: {}".format(e))
+        terms = set(term for _, rule_terms in self._contains for term in rule_terms)
+        self._terms = re.compile("|".join(re.escape(term) for term in sorted(terms))) if terms else None
+
+    @classmethod
+    def from_config(cls, config, map_name=None):
+        """Builds the filter for a map from [chat_filters] and its [chat_filters.<map>] overrides"""
+        # Read raw, so a % in a rule is just a % and not ConfigParser interpolation
+        if config.has_section("chat_filters"):
+            rules = OrderedDict(config.items("chat_filters", raw=True))
+        else:
+            rules = OrderedDict(DEFAULT_CHAT_FILTERS)
+        section = "chat_filters.{}".format(map_name)
+        if map_name and config.has_section(section):
+            rules.update(config.items(section, raw=True))
+        # items() includes the DEFAULT section, which isn't a filter
+        for key in config.defaults():
+            rules.pop(key, None)
+        return cls(rules)
+
+    def classify(self, line):
+        """Returns the name of the rule matching line, or None if it matches none"""
+        hit = None
+        if self._pattern is not None:
+            match = self._pattern.match(line)
+            if match is not None:
+                hit = int(match.lastgroup[4:])
+        # A flagged rule only wins over the combined match when it comes first
+        for rank, name, pattern in self._flagged:
+            if hit is not None and rank > self._group_ranks[hit]:
+                break
+            if pattern.search(line) is not None:
+                return name
+        if hit is not None:
+            return self._group_names[hit]
+        if self._terms is not None and self._terms.search(line) is not None:
+            for name, terms in self._contains:
+                if all(term in line for term in terms):
+                    return name
+        return None
+
+    def is_filtered(self, line):
+        return self.classify(line) is not None
+
+
+class ChatBatcher(object):
+    """Packs chat lines for each channel into as few Discord messages as possible
+
+    Lines are wrapped in a single code block per message, up to Discord's
+    max_length characters. A channel's batch is sent as soon as the next line
+    wouldn't fit, or max_delay seconds after its first line was added,
+    whichever comes first. send is a coroutine function called with
+    (channel, message). Sends for a channel never overlap, so messages stay
+    in order.
+    """
+    BLOCK = "```"
+
+    def __init__(self, send, max_length=2000, max_delay=2.0):
+        self.send = send
+        self.max_length = max_length
+        self.max_delay = max_delay
+        # Channel -> [lines, message length so far, time of the first line]
+        self._pending = {}
+        self._timers = {}
+        self._locks = {}
+
+    def _message_length(self, lines_length, line_count):
+        return lines_length + line_count - 1 + 2 * len(self.BLOCK)
+
+    async def add(self, channel, line):
+        # A line that can't fit in a message on its own is split over several
+        room = self.max_length - 2 * len(self.BLOCK)
+        while len(line) > room:
+            await self.add(channel, line[:room])
+            line = line[room:]
+
+        batch = self._pending.get(channel)
+        if batch and self._message_length(batch[1] + len(line), len(batch[0]) + 1) > self.max_length:
+            await self.flush(channel)
+            batch = None
+        if not batch:
+            batch = self._pending[channel] = [[], 0, time.monotonic()]
+            self._timers[channel] = asyncio.ensure_future(self._flush_later(channel, batch))
+        batch[0].append(line)
+        batch[1] += len(line)
+
+    async def _flush_later(self, channel, batch):
+        await asyncio.sleep(self.max_delay)
+        if self._pending.get(channel) is batch:
+            # Don't let flush() cancel this task while it sends
+            del self._timers[channel]
+            await self.flush(channel)
+
+    async def flush(self, channel):
+        batch = self._pending.pop(channel, None)
+        timer = self._timers.pop(channel, None)
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return
+
+        lock = self._locks.get(channel)
+        if lock is None:
+            lock = self._locks[channel] = asyncio.Lock()
+        message = "{0}{1}{0}".format(self.BLOCK, "\n".join(batch[0]))
+        async with lock:
+            try:
+                await self.send(channel, message)
+            except Exception:
+                log.error("Unable to send {} chat line(s) to {}:\n{}".format(len(batch[0]), channel,
+                                                                             traceback.format_exc()))
+
+    async def flush_all(self):
+        for channel in list(self._pending):
+            await self.flush(channel)
+
+
+def compress_file(path):
+    """gzips path to path.gz and removes the original"""
+    try:
+        with open(path, "rb") as in_file, gzip.open(path + ".gz", "wb") as out_file:
+            shutil.copyfileobj(in_file, out_file)
+        os.remove(path)
+    except OSError:
+        log.error("Unable to compress {}:\n{}".format(path, traceback.format_exc()))
+
+
+class ChatArchive(object):
+    """Appends chat lines to a log file, keeping it open and writing in batches
+
+    Lines are buffered in memory until flush() (or until buffer_size bytes are
+    waiting) and written with a single write. The file is fsynced at most
+    every fsync_interval seconds. The file is rotated when it would grow past
+    max_bytes (0 to disable) and, if rotate_daily is set, when the first line
+    of a new day is written. Rotated files are renamed to
+    <name>.<YYYY-MM-DD>[.<n>]<ext> and, with compress, gzipped in a
+    background thread.
+    """
+    def __init__(self, path, max_bytes=0, rotate_daily=True, compress=False, fsync_interval=60,
+                 buffer_size=64 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self._file = None
+        self._size = 0
+        self._day = None
+        self._buffer = []
+        self._buffered = 0
+        self._last_fsync = time.monotonic()
+
+    def write(self, line, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        local_time = time.localtime(timestamp)
+        day = time.strftime("%Y-%m-%d", local_time)
+        if self._file is None:
+            self._open()
+        if self.rotate_daily and self._day is not None and day != self._day:
+            # Lines from the old day go into the old file
+            self.flush()
+            self._rotate()
+        self._day = self._day or day
+
+        data = "{} {}\n".format(time.strftime("[%Y/%m/%d %H:%M:%S]", local_time), line).encode("utf-8")
+        if self.max_bytes and self._size + self._buffered + len(data) > self.max_bytes and \
+                self._size + self._buffered > 0:
+            self.flush()
+            self._rotate()
+            self._day = day
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab")
+        stat = os.fstat(self._file.fileno())
+        self._size = stat.st_size
+        if self._size and self._day is None:
+            # Carry on with an existing file, it belongs to the day it was last written
+            self._day = time.strftime("%Y-%m-%d", time.localtime(stat.st_mtime))
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._open()
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def _rotated_path(self):
+        base, ext = os.path.splitext(self.path)
+        day = self._day or time.strftime("%Y-%m-%d")
+        candidate = "{}.{}{}".format(base, day, ext)
+        count = 1
+        while os.path.exists(candidate) or os.path.exists(candidate + ".gz"):
+            candidate = "{}.{}.{}{}".format(base, day, count, ext)
+            count += 1
+        return candidate
+
+    def _rotate(self):
+        if self._file is None and not os.path.exists(self.path):
+            self._day = None
+            return
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        if os.path.getsize(self.path):
+            rotated = self._rotated_path()
+            os.rename(self.path, rotated)
+            if self.compress:
+                threading.Thread(target=compress_file, args=(rotated,), daemon=True).start()
+        self._size = 0
+        self._day = None
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class AdaptivePollInterval(object):
+    """Works out how long to wait before the next getchat poll of a map
+
+    Any chat drops the interval straight to min_interval. Every quiet poll
+    after that multiplies it by backoff, up to max_interval while players
+    are online, or up to empty_interval when the map is empty (or offline).
+    """
+    def __init__(self, min_interval=2, max_interval=15, empty_interval=60, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.empty_interval = empty_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def next(self, chat_lines, player_count=None):
+        """Returns the next interval, player_count None means it isn't known"""
+        if chat_lines:
+            self.interval = self.min_interval
+        else:
+            limit = self.empty_interval if player_count == 0 else self.max_interval
+            self.interval = min(max(self.interval * self.backoff, self.min_interval), limit)
+        return self.interval
+
+
+class ChatDeduplicator(object):
+    """Drops the lines of a getchat batch that were already relayed
+
+    A poll that is retried, or answered again after a reconnect, comes back
+    starting with lines we have already seen. The hashes of the last window
+    lines are kept, and a batch whose first lines repeat the end of that
+    window has the repeated part removed.
+
+    ARK's chat lines have no timestamps or ids, so one matching line could
+    just as well be a player saying the same thing twice. Only overlaps of
+    at least min_overlap lines are treated as a replay.
+    """
+    def __init__(self, window=256, min_overlap=2):
+        self.window = deque(maxlen=window)
+        self.min_overlap = min_overlap
+        self.suppressed = 0
+
+    def _overlap(self, hashes):
+        window = list(self.window)
+        # Longest overlap first, only trying the positions that match the first line
+        for start in range(max(len(window) - len(hashes), 0), len(window) - self.min_overlap + 1):
+            if window[start] == hashes[0] and window[start:] == hashes[:len(window) - start]:
+                return len(window) - start
+        return 0
+
+    def filter(self, lines):
+        """Returns lines without the part already relayed and remembers them"""
+        hashes = [hash(line) for line in lines]
+        overlap = self._overlap(hashes) if len(hashes) >= self.min_overlap else 0
+        if overlap:
+            self.suppressed += overlap
+            log.debug("Suppressed {} replayed chat line(s)".format(overlap))
+        self.window.extend(hashes[overlap:])
+        return lines[overlap:]
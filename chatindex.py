@@ -0,0 +1,161 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Full text index of the relayed chat, for !searchchat"""
+
+import logging
+import os
+import re
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+# "SteamName (CharacterName): message", the format of player chat in getchat
+CHAT_LINE = re.compile(r"^(.+?) \((.*?)\): (.*)$", re.DOTALL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_lines (
+    id INTEGER PRIMARY KEY,
+    map TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_lines_ts ON chat_lines (ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+    player, text, content='chat_lines', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+
+def split_chat_line(line):
+    """Returns (player, text) for a chat line, player is "" for server messages"""
+    match = CHAT_LINE.match(line)
+    if not match:
+        return "", line
+    return "{} ({})".format(match.group(1), match.group(2)), match.group(3)
+
+
+def fts_phrase(value):
+    """Quotes user input as an FTS5 string, so it can't be read as query syntax"""
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+class ChatIndex(object):
+    """SQLite FTS5 index of chat lines with their map, time and player
+
+    Lines are kept in chat_lines (indexed on the time) with an external
+    content FTS5 table over the player and text columns. add() only buffers,
+    it never touches the database; flush() writes everything buffered in one
+    transaction and is the only write that can raise sqlite3.Error. The
+    database runs in WAL mode so searches don't block the writes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pending = []
+        self.db = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def add(self, map_name, line, timestamp=None):
+        player, text = split_chat_line(line)
+        self._pending.append((map_name, int(timestamp if timestamp is not None else time.time()), player, text))
+
+    def flush(self):
+        if not self._pending or self.db is None:
+            return
+        rows, self._pending = self._pending, []
+        with self.db:
+            cursor = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM chat_lines")
+            first_id = cursor.fetchone()[0] + 1
+            numbered = [(first_id + idx,) + row for idx, row in enumerate(rows)]
+            self.db.executemany("INSERT INTO chat_lines (id, map, ts, player, text) VALUES (?, ?, ?, ?, ?)", numbered)
+            self.db.executemany("INSERT INTO chat_fts (rowid, player, text) VALUES (?, ?, ?)",
+                                [(row[0], row[3], row[4]) for row in numbered])
+
+    def _id_bound(self, ts, first):
+        """Returns the first id at or after ts (first) or the last id at or before ts (not first)"""
+        if first:
+            query = "SELECT id FROM chat_lines WHERE ts >= ? ORDER BY ts, id LIMIT 1"
+        else:
+            query = "SELECT id FROM chat_lines WHERE ts <= ? ORDER BY ts DESC, id DESC LIMIT 1"
+        row = self.db.execute(query, (int(ts),)).fetchone()
+        return row[0] if row else None
+
+    def search(self, terms=None, player=None, map_name=None, since=None, until=None, page=1, page_size=10):
+        """Returns ([(map, ts, player, text)], more) for one page of matches, newest first
+
+        terms are matched as words (all of them) in the text, player as
+        words in the player name. more is True when there is another page.
+
+        Lines are added in time order, so the id order is the time order and
+        the time range becomes an id range. FTS5 can then walk its matches
+        newest first and stop at the page, instead of collecting every match.
+        """
+        self.flush()
+        where = []
+        params = []
+        if since is not None:
+            first_id = self._id_bound(since, True)
+            if first_id is None:
+                return [], False
+            where.append("chat_lines.id >= ?")
+            params.append(first_id)
+        if until is not None:
+            last_id = self._id_bound(until, False)
+            if last_id is None:
+                return [], False
+            where.append("chat_lines.id <= ?")
+            params.append(last_id)
+        if map_name:
+            where.append("chat_lines.map = ?")
+            params.append(map_name)
+
+        match = []
+        if terms:
+            match.append("text : ({})".format(" ".join(fts_phrase(term) for term in terms)))
+        if player:
+            match.append("player : {}".format(fts_phrase(player)))
+        if match:
+            query = "SELECT map, ts, chat_lines.player, chat_lines.text FROM chat_fts " \
+                    "JOIN chat_lines ON chat_lines.id = chat_fts.rowid WHERE chat_fts MATCH ?"
+            params.insert(0, " AND ".join(match))
+            # Bound the rowids too, FTS5 only skips ahead for constraints on its own rowid
+            where = [clause.replace("chat_lines.id", "chat_fts.rowid") for clause in where]
+            order = "chat_fts.rowid"
+        else:
+            query = "SELECT map, ts, player, text FROM chat_lines WHERE 1"
+            order = "chat_lines.id"
+        for clause in where:
+            query += " AND " + clause
+        query += " ORDER BY {} DESC LIMIT ? OFFSET ?".format(order)
+        params += [page_size + 1, (max(page, 1) - 1) * page_size]
+        rows = self.db.execute(query, params).fetchall()
+        return rows[:page_size], len(rows) > page_size
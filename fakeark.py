@@ -0,0 +1,404 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local stand-in for an ARK server's RCON and A2S query endpoints
+
+Used by benchmark.py and for trying out pyarkon/pysteamapi without a live
+map. It can be run standalone:
+
+    python fakeark.py --rcon-port 27020 --query-port 27015 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import struct
+import threading
+import time
+
+from pyarkon import (PACKET_ID_TYPE, PACKET_OVERHEAD, PACKET_SIZE, RCONPacketFramer, SERVERDATA_AUTH,
+                     SERVERDATA_RESPONSE_VALUE)
+
+log = logging.getLogger(__name__)
+
+SERVERDATA_AUTH_RESPONSE = 0x02
+NO_RESPONSE = b"Server received, But no response!! \n "
+
+A2S_HEADER = b"\xff\xff\xff\xff"
+A2S_INFO_REQUEST = b"\xff\xff\xff\xffTSource Engine Query\x00"
+
+DEFAULT_PLAYERS = ["Survivor", "Dodo Lover", "Rex Tamer", "Yutyrannus", "Pteranodon Pilot"]
+DEFAULT_MODS = ["731604991", "741203089", "520879363", "566885854", "566887000", "793605978", "804312798"]
+
+
+class FakeArkServer(object):
+    """Fake ARK server with an RCON TCP endpoint and an A2S UDP endpoint
+
+    latency          seconds to wait before answering any request
+    chat_lines       number of chat lines returned by each getchat
+    chat_line_size   approximate length of each generated chat line
+    player_count     number of players reported by listplayers and A2S_PLAYER
+    mod_count        number of MODx entries reported by A2S_RULES
+    packet_split     split RCON response bodies into packets of this many bytes
+    chunk_size       write RCON responses to the socket in chunks of this size
+    drop_rate        chance of silently ignoring a request
+    challenge_lifetime  seconds before the A2S challenge token is re-issued (0 = never)
+    a2s_split_size   split A2S responses into 0xFFFFFFFE packets of this many bytes
+    a2s_shuffle      send split A2S packets in random order
+    disconnect_rate  chance of closing the RCON connection instead of answering
+    """
+    def __init__(self, host="127.0.0.1", rcon_port=0, query_port=0, password="password", server_name="TheIsland",
+                 latency=0.0, chat_lines=5, chat_line_size=60, player_count=5, mod_count=7, packet_split=0,
+                 chunk_size=0, drop_rate=0.0, disconnect_rate=0.0, challenge_lifetime=0, a2s_split_size=0,
+                 a2s_shuffle=False, seed=None):
+        self.host = host
+        self.rcon_port = rcon_port
+        self.query_port = query_port
+        self.password = password
+        self.server_name = server_name
+        self.latency = latency
+        self.chat_lines = chat_lines
+        self.chat_line_size = chat_line_size
+        self.player_count = player_count
+        self.mod_count = mod_count
+        self.packet_split = packet_split
+        self.chunk_size = chunk_size
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.challenge_lifetime = challenge_lifetime
+        self.a2s_split_size = a2s_split_size
+        self.a2s_shuffle = a2s_shuffle
+        self._split_id = 0
+        self.challenge = self.random.getrandbits(31)
+        self.challenge_issued = time.monotonic()
+        self.stats = {"rcon_connections": 0, "rcon_commands": 0, "a2s_requests": 0, "dropped": 0}
+        self.loop = None
+        self._rcon_server = None
+        self._transport = None
+        self._thread = None
+        self._handlers = set()
+        self._chat_counter = 0
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self._rcon_server = await asyncio.start_server(self._handle_rcon, self.host, self.rcon_port)
+        self.rcon_port = self._rcon_server.sockets[0].getsockname()[1]
+        self._transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _A2SProtocol(self), local_addr=(self.host, self.query_port))
+        self.query_port = self._transport.get_extra_info("sockname")[1]
+        log.debug("Fake ARK server listening on RCON {} / query {}".format(self.rcon_port, self.query_port))
+
+    async def stop(self):
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+        if self._rcon_server:
+            self._rcon_server.close()
+            for writer in list(self._handlers):
+                writer.close()
+            while self._handlers:
+                await asyncio.sleep(0.01)
+            await self._rcon_server.wait_closed()
+            self._rcon_server = None
+
+    def start_in_thread(self):
+        """Runs the server on its own event loop, for use with the blocking clients"""
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name="fakeark", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        if self._thread:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info):
+        self.stop_thread()
+
+    def _should_drop(self):
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return True
+        return False
+
+    def build_chat(self):
+        lines = []
+        for _ in range(self.chat_lines):
+            self._chat_counter += 1
+            name = self.random.choice(DEFAULT_PLAYERS)
+            prefix = "{} ({}): ".format(name, name.split()[0])
+            filler = "message {} ".format(self._chat_counter)
+            filler = (filler * (self.chat_line_size // len(filler) + 1))[:max(self.chat_line_size - len(prefix), 1)]
+            lines.append(prefix + filler)
+        if not lines:
+            return NO_RESPONSE
+        return ("\n".join(lines) + "\n").encode("utf8")
+
+    def build_player_list(self):
+        if not self.player_count:
+            return b"No Players Connected \n "
+        lines = ["{}. {}, {}".format(idx, self.player_name(idx), 76561198000000000 + idx)
+                 for idx in range(self.player_count)]
+        return ("\n".join(lines) + "\n ").encode("utf8")
+
+    def player_name(self, idx):
+        return "{} {}".format(DEFAULT_PLAYERS[idx % len(DEFAULT_PLAYERS)], idx)
+
+    def run_command(self, command):
+        name = command.split(" ", 1)[0].lower()
+        if name == "getchat":
+            return self.build_chat()
+        elif name == "listplayers":
+            return self.build_player_list()
+        elif name == "showmessageoftheday":
+            return b"Message of the day shown \n "
+        return NO_RESPONSE
+
+    def build_rcon_packets(self, request_id, body, packet_type=SERVERDATA_RESPONSE_VALUE):
+        if self.packet_split and len(body) > self.packet_split:
+            parts = [body[idx:idx + self.packet_split] for idx in range(0, len(body), self.packet_split)]
+        else:
+            parts = [body]
+
+        return b"".join(PACKET_SIZE.pack(len(part) + PACKET_OVERHEAD) + PACKET_ID_TYPE.pack(request_id, packet_type) +
+                        part + b"\x00\x00" for part in parts)
+
+    async def _write_responses(self, writer, queue):
+        # Responses are delayed by the configured latency from the moment the
+        # request was read, without holding up the requests behind it
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                break
+            delay = due - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            step = self.chunk_size or len(data)
+            for idx in range(0, len(data), step):
+                writer.write(data[idx:idx + step])
+                await writer.drain()
+
+    async def _handle_rcon(self, reader, writer):
+        self.stats["rcon_connections"] += 1
+        self._handlers.add(writer)
+        framer = RCONPacketFramer()
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self._write_responses(writer, queue))
+        authenticated = False
+        try:
+            while not sender.done():
+                data = await reader.read(4096)
+                if not data:
+                    break
+                framer.feed(data)
+                packet = framer.next_packet()
+                while packet is not None:
+                    request_id, packet_type, body = packet
+                    packet = framer.next_packet()
+                    due = self.loop.time() + self.latency
+                    if packet_type == SERVERDATA_AUTH:
+                        authenticated = body.decode("utf8", "replace") == self.password
+                        response_id = request_id if authenticated else -1
+                        queue.put_nowait((due, self.build_rcon_packets(response_id, b"", SERVERDATA_AUTH_RESPONSE)))
+                        continue
+
+                    if packet_type == SERVERDATA_RESPONSE_VALUE:
+                        # Multi-packet sentinel, echo it back once the previous response is out
+                        queue.put_nowait((due, self.build_rcon_packets(request_id, b"")))
+                        continue
+
+                    self.stats["rcon_commands"] += 1
+                    if not authenticated:
+                        queue.put_nowait((due, self.build_rcon_packets(-1, b"")))
+                        continue
+                    if self.disconnect_rate and self.random.random() < self.disconnect_rate:
+                        return
+                    if self._should_drop():
+                        continue
+                    response = self.run_command(body.decode("utf8", "replace"))
+                    queue.put_nowait((due, self.build_rcon_packets(request_id, response)))
+            queue.put_nowait((0, None))
+            await sender
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+            self._handlers.discard(writer)
+
+    def build_a2s_info(self):
+        data = bytearray(A2S_HEADER + b"I\x11")
+        data += "{} - (v357.4)\x00".format(self.server_name).encode("utf8")
+        data += b"TheIsland\x00ark_survival_evolved\x00ARK: Survival Evolved\x00"
+        data += struct.pack("<hBBBccBB", 0, min(self.player_count, 255), 70, 0, b"d", b"l", 0, 1)
+        data += b"1.0.0.0\x00"
+        data += struct.pack("<B", 0x80 | 0x10 | 0x01)
+        data += struct.pack("<hq", 7777, 90112345678901234)
+        data += struct.pack("<q", 346110)
+        return bytes(data)
+
+    def build_a2s_rules(self):
+        rules = [
+            ("ALLOWDOWNLOADCHARS_i", "1"),
+            ("ALLOWDOWNLOADITEMS_i", "1"),
+            ("ClusterId_s", "aah"),
+            ("CUSTOMSERVERNAME_s", self.server_name.lower()),
+            ("DayTime_s", "542"),
+            ("GameMode_s", "TestGameMode_C"),
+            ("HASACTIVEMODS_i", "1" if self.mod_count else "0"),
+            ("Networking_i", "0"),
+            ("OFFICIALSERVER_i", "0"),
+            ("SESSIONISPVE_i", "1"),
+            ("ServerPassword_b", "false"),
+        ]
+        for idx in range(self.mod_count):
+            mod_id = DEFAULT_MODS[idx % len(DEFAULT_MODS)]
+            rules.append(("MOD{}_s".format(idx), "{}:{:032X}".format(mod_id, self.random.getrandbits(128))))
+
+        data = bytearray(A2S_HEADER + b"E")
+        data += struct.pack("<h", len(rules))
+        for name, value in rules:
+            data += name.encode("utf8") + b"\x00" + value.encode("utf8") + b"\x00"
+        return bytes(data)
+
+    def build_a2s_players(self):
+        data = bytearray(A2S_HEADER + b"D")
+        data += struct.pack("<B", min(self.player_count, 255))
+        for idx in range(min(self.player_count, 255)):
+            data += struct.pack("<B", idx)
+            data += self.player_name(idx).encode("utf8") + b"\x00"
+            data += struct.pack("<if", idx, 60.0 * (idx + 1) + 0.5)
+        return bytes(data)
+
+    def build_a2s_challenge(self):
+        if self.challenge_lifetime and time.monotonic() - self.challenge_issued > self.challenge_lifetime:
+            self.challenge = self.random.getrandbits(31)
+            self.challenge_issued = time.monotonic()
+        return A2S_HEADER + b"A" + struct.pack("<i", self.challenge)
+
+    def split_a2s(self, response):
+        """Splits a response into Source engine 0xFFFFFFFE packets"""
+        if not self.a2s_split_size or len(response) <= self.a2s_split_size:
+            return [response]
+
+        self._split_id = (self._split_id + 1) & 0x7fffffff
+        parts = [response[idx:idx + self.a2s_split_size] for idx in range(0, len(response), self.a2s_split_size)]
+        packets = [struct.pack("<iIBBh", -2, self._split_id, len(parts), number, self.a2s_split_size) + part
+                   for number, part in enumerate(parts)]
+        if self.a2s_shuffle:
+            self.random.shuffle(packets)
+        return packets
+
+    def answer_a2s(self, data):
+        if data.startswith(A2S_INFO_REQUEST):
+            return self.build_a2s_info()
+        if len(data) < 9 or not data.startswith(A2S_HEADER):
+            return None
+
+        kind = data[4:5]
+        challenge = struct.unpack("<i", data[5:9])[0]
+        if kind not in (b"V", b"U"):
+            return None
+        expired = self.challenge_lifetime and time.monotonic() - self.challenge_issued > self.challenge_lifetime
+        if challenge != self.challenge or expired:
+            return self.build_a2s_challenge()
+        if kind == b"V":
+            return self.build_a2s_rules()
+        return self.build_a2s_players()
+
+
+class _A2SProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.stats["a2s_requests"] += 1
+        if self.server._should_drop():
+            return
+        response = self.server.answer_a2s(data)
+        if response is None:
+            return
+        if self.server.latency:
+            self.server.loop.call_later(self.server.latency, self._reply, response, addr)
+        else:
+            self._reply(response, addr)
+
+    def _reply(self, response, addr):
+        if self.transport:
+            for packet in self.server.split_a2s(response):
+                self.transport.sendto(packet, addr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake ARK server for local testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--rcon-port", type=int, default=27020)
+    parser.add_argument("--query-port", type=int, default=27015)
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--chat-lines", type=int, default=5)
+    parser.add_argument("--players", type=int, default=5)
+    parser.add_argument("--mods", type=int, default=7)
+    parser.add_argument("--packet-split", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--challenge-lifetime", type=float, default=0.0)
+    parser.add_argument("--a2s-split-size", type=int, default=0)
+    parser.add_argument("--a2s-shuffle", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    server = FakeArkServer(host=args.host, rcon_port=args.rcon_port, query_port=args.query_port,
+                           password=args.password, latency=args.latency, chat_lines=args.chat_lines,
+                           player_count=args.players, mod_count=args.mods, packet_split=args.packet_split,
+                           chunk_size=args.chunk_size, drop_rate=args.drop_rate,
+                           disconnect_rate=args.disconnect_rate, challenge_lifetime=args.challenge_lifetime,
+                           a2s_split_size=args.a2s_split_size, a2s_shuffle=args.a2s_shuffle)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start())
+    print("RCON on {}:{}, A2S on {}:{}".format(args.host, server.rcon_port, args.host, server.query_port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import logging
+import os
+import struct
+import time
+import traceback
+
+from array import array
+
+log = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 24 * HOUR
+# Six months of hourly buckets
+DEFAULT_RETENTION_HOURS = 186 * 24
+CLUSTER = "cluster"
+# Seconds two session starts can differ by and still be the same connection (A2S durations drift)
+SESSION_SLACK = 60
+# Seconds an ended session can still be carried on by a player showing up again with the same start
+RECENT_SESSION = 600
+
+# Magic, format version, retention in hours, all-time peak, time of the all-time peak
+HISTORY_HEADER = struct.Struct("<4sHIIq")
+HISTORY_MAGIC = b"AAHH"
+HISTORY_VERSION = 1
+
+
+def write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(data)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class MapHistory(object):
+    """Player counts for one map, bucketed by hour in fixed-size arrays
+
+    Each bucket keeps the peak, the sum and the number of samples for one hour,
+    in a ring of retention_hours slots, so memory and file size stay the same
+    no matter how long the bot runs (about 16 bytes per hour kept).
+    """
+    def __init__(self, retention_hours=DEFAULT_RETENTION_HOURS):
+        self.retention = retention_hours
+        # Absolute hour number held by each slot, -1 when unused
+        self.hours = array("q", [-1]) * retention_hours
+        self.peaks = array("H", [0]) * retention_hours
+        self.totals = array("I", [0]) * retention_hours
+        self.samples = array("H", [0]) * retention_hours
+        self.peak = 0
+        self.peak_time = 0
+
+    def record(self, count, timestamp):
+        hour = int(timestamp // HOUR)
+        slot = hour % self.retention
+        if self.hours[slot] != hour:
+            self.hours[slot] = hour
+            self.peaks[slot] = 0
+            self.totals[slot] = 0
+            self.samples[slot] = 0
+
+        count = min(count, 0xffff)
+        if count > self.peaks[slot]:
+            self.peaks[slot] = count
+        self.totals[slot] += count
+        if self.samples[slot] < 0xffff:
+            self.samples[slot] += 1
+        if count > self.peak:
+            self.peak = count
+            self.peak_time = int(timestamp)
+
+    def hour(self, hour):
+        """Returns (peak, average) for an absolute hour number, or None if there is no data"""
+        slot = hour % self.retention
+        if self.hours[slot] != hour or not self.samples[slot]:
+            return None
+        return self.peaks[slot], self.totals[slot] / float(self.samples[slot])
+
+    def hourly(self, end_time, hours=24):
+        """Returns [(hour start time, peak, average)] for the hours up to end_time, oldest first"""
+        last_hour = int(end_time // HOUR)
+        out = []
+        for hour in range(last_hour - hours + 1, last_hour + 1):
+            data = self.hour(hour)
+            if data:
+                out.append((hour * HOUR, data[0], data[1]))
+            else:
+                out.append((hour * HOUR, None, None))
+        return out
+
+    def daily(self, end_time, days=7):
+        """Returns [(day start time, peak, average)] for the UTC days up to end_time, oldest first"""
+        last_day = int(end_time // DAY)
+        out = []
+        for day in range(last_day - days + 1, last_day + 1):
+            peak = None
+            total = 0.0
+            hours_with_data = 0
+            for hour in range(day * 24, day * 24 + 24):
+                data = self.hour(hour)
+                if data:
+                    peak = max(peak or 0, data[0])
+                    total += data[1]
+                    hours_with_data += 1
+            average = total / hours_with_data if hours_with_data else None
+            out.append((day * DAY, peak, average))
+        return out
+
+    def peak_since(self, start_time, end_time):
+        """Returns (peak, hour start time) between two times, (0, None) without data"""
+        best = (0, None)
+        for hour in range(int(start_time // HOUR), int(end_time // HOUR) + 1):
+            data = self.hour(hour)
+            if data and data[0] > best[0]:
+                best = (data[0], hour * HOUR)
+        return best
+
+    def to_bytes(self):
+        header = HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_VERSION, self.retention, self.peak, self.peak_time)
+        return header + self.hours.tobytes() + self.peaks.tobytes() + self.totals.tobytes() + self.samples.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, retention_hours=DEFAULT_RETENTION_HOURS):
+        magic, version, retention, peak, peak_time = HISTORY_HEADER.unpack_from(data)
+        if magic != HISTORY_MAGIC or version != HISTORY_VERSION:
+            raise ValueError("Not a player history file")
+
+        stored = cls(retention)
+        expected = HISTORY_HEADER.size + retention * sum(values.itemsize for values in (
+            stored.hours, stored.peaks, stored.totals, stored.samples))
+        if len(data) != expected:
+            raise ValueError("Truncated player history file")
+
+        idx = HISTORY_HEADER.size
+        for values in (stored.hours, stored.peaks, stored.totals, stored.samples):
+            size = values.itemsize * retention
+            values[:] = array(values.typecode, data[idx:idx + size])
+            idx += size
+        stored.peak = peak
+        stored.peak_time = peak_time
+        if retention == retention_hours:
+            return stored
+
+        # The retention setting changed, move the newest hours into a ring of the new size
+        history = cls(retention_hours)
+        history.peak = peak
+        history.peak_time = peak_time
+        newest = max(stored.hours)
+        for slot, hour in enumerate(stored.hours):
+            if hour < 0 or hour <= newest - retention_hours:
+                continue
+            new_slot = hour % retention_hours
+            history.hours[new_slot] = hour
+            history.peaks[new_slot] = stored.peaks[slot]
+            history.totals[new_slot] = stored.totals[slot]
+            history.samples[new_slot] = stored.samples[slot]
+        return history
+
+
+class PlayerHistory(object):
+    """Player counts and sessions for the whole cluster, fed by A2S polling
+
+    Counts go into a MapHistory per map (plus CLUSTER for the cluster-wide
+    total). Sessions are derived from the A2S_PLAYER connection durations and
+    folded into a running playtime total per player name when the player
+    leaves, so the leaderboard never scans old data.
+
+    Everything is stored under path: one <map>.hist file per map and
+    sessions.json for the playtime totals and sessions in progress.
+    """
+    def __init__(self, path, maps, retention_hours=DEFAULT_RETENTION_HOURS, save_interval=300):
+        self.path = path
+        self.retention = retention_hours
+        self.save_interval = save_interval
+        self.maps = {}
+        for name in list(maps) + [CLUSTER]:
+            self.maps[name] = MapHistory(retention_hours)
+        # Player name -> [seconds played, sessions]
+        self.playtime = {}
+        # Map name -> {player name: [session start, last seen]}
+        self.online = {}
+        # Map name -> {player name: [session start, last seen]} for sessions that ended in the last
+        # RECENT_SESSION seconds, so a player missing from one poll carries on the same session
+        self.ended = {}
+        self.last_counts = {}
+        self.last_saved = time.monotonic()
+
+    def _map_file(self, name):
+        return os.path.join(self.path, "{}.hist".format(name))
+
+    def _sessions_file(self):
+        return os.path.join(self.path, "sessions.json")
+
+    def load(self):
+        for name in self.maps:
+            try:
+                with open(self._map_file(name), "rb") as history_file:
+                    self.maps[name] = MapHistory.from_bytes(history_file.read(), self.retention)
+            except FileNotFoundError:
+                pass
+            except (ValueError, struct.error):
+                log.error("Ignoring corrupt player history file for {}".format(name))
+
+        try:
+            with open(self._sessions_file(), "r") as sessions_file:
+                data = json.load(sessions_file)
+            self.playtime = data.get("playtime", {})
+            self.online = data.get("online", {})
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.error("Ignoring corrupt player sessions file")
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name, history in self.maps.items():
+            write_atomic(self._map_file(name), history.to_bytes())
+        data = json.dumps({"playtime": self.playtime, "online": self.online})
+        write_atomic(self._sessions_file(), data.encode("utf8"))
+        self.last_saved = time.monotonic()
+
+    def _end_session(self, name, start, last_seen):
+        totals = self.playtime.setdefault(name, [0, 0])
+        totals[0] += max(int(last_seen - start), 0)
+        totals[1] += 1
+
+    def _resume_session(self, name, start, last_seen):
+        """Takes an ended session back out of the playtime totals, to carry it on"""
+        totals = self.playtime[name]
+        totals[0] -= max(int(last_seen - start), 0)
+        totals[1] -= 1
+
+    def record(self, snapshots, timestamp=None):
+        """Records one poll, snapshots is {map name: ServerSnapshotService snapshot}"""
+        if timestamp is None:
+            timestamp = time.time()
+
+        for name, snapshot in snapshots.items():
+            if name not in self.maps or snapshot is None:
+                continue
+            if not snapshot["players_known"]:
+                # The player list didn't come back, which says nothing about who's online. Leave the
+                # sessions open and keep the last count for the cluster total rather than record a 0
+                continue
+            players = snapshot["A2S_PLAYERS"]
+            self.last_counts[name] = len(players)
+            self.maps[name].record(len(players), timestamp)
+
+            online = self.online.setdefault(name, {})
+            ended = self.ended.setdefault(name, {})
+            for player_name in [player_name for player_name, session in ended.items()
+                                if timestamp - session[1] > RECENT_SESSION]:
+                del ended[player_name]
+            seen = set()
+            for player in players:
+                player_name = player["player_name"]
+                if not player_name:
+                    continue
+                seen.add(player_name)
+                start = timestamp - player["duration"]
+                session = online.get(player_name)
+                # A much later start than we had means they reconnected in between polls
+                if session and start - session[0] > SESSION_SLACK:
+                    self._end_session(player_name, session[0], session[1])
+                    session = None
+                if session:
+                    session[1] = timestamp
+                    continue
+                session = ended.pop(player_name, None)
+                if session and abs(start - session[0]) <= SESSION_SLACK:
+                    # Same connection as a session that just ended, they only went missing from a poll
+                    self._resume_session(player_name, session[0], session[1])
+                    online[player_name] = [session[0], timestamp]
+                else:
+                    online[player_name] = [start, timestamp]
+
+            for player_name in [player_name for player_name in online if player_name not in seen]:
+                start, last_seen = online.pop(player_name)
+                self._end_session(player_name, start, last_seen)
+                ended[player_name] = [start, last_seen]
+
+        self.maps[CLUSTER].record(sum(self.last_counts.values()), timestamp)
+
+        if time.monotonic() - self.last_saved >= self.save_interval:
+            try:
+                self.save()
+            except OSError:
+                log.error("Unable to save the player history:\n{}".format(traceback.format_exc()))
+
+    def leaderboard(self, count=10, now=None):
+        """Returns the top [(player name, seconds played, sessions)], including sessions in progress
+
+        Sessions in progress count up to now, but no more than RECENT_SESSION
+        past the last poll that saw the player (the map may have stopped
+        answering, and they may be long gone).
+        """
+        if now is None:
+            now = time.time()
+        totals = dict((name, list(values)) for name, values in self.playtime.items())
+        for online in self.online.values():
+            for name, (start, last_seen) in online.items():
+                values = totals.setdefault(name, [0, 0])
+                values[0] += max(int(min(now, last_seen + RECENT_SESSION) - start), 0)
+                values[1] += 1
+        return heapq.nlargest(count, ((name, values[0], values[1]) for name, values in totals.items()),
+                              key=lambda item: item[1])
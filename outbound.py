@@ -0,0 +1,265 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+import traceback
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Priority classes, lower goes first
+ALERT = 0
+REPLY = 1
+CHAT = 2
+
+# Discord's documented limits are 5 messages per 5 seconds per channel and 50 requests per second overall
+CHANNEL_RATE = 1.0
+CHANNEL_BURST = 5
+GLOBAL_RATE = 40.0
+GLOBAL_BURST = 40
+MAX_MESSAGE_LENGTH = 2000
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # Set after a 429, no tokens are handed out before this time
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available, 0 if one is available now"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class OutboundMessage(object):
+    __slots__ = ("priority", "channel", "content", "embed", "message", "future", "queued")
+
+    def __init__(self, priority, channel, content=None, embed=None, message=None, future=None):
+        self.priority = priority
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        # The message to edit, None for a new message
+        self.message = message
+        self.future = future
+        self.queued = time.monotonic()
+
+
+class OutboundQueue(object):
+    """Sends everything the bot posts to Discord, most important first
+
+    Messages are queued per channel with a priority class (ALERT, REPLY or
+    CHAT) and sent by run() as the per channel and global token buckets
+    allow. Each channel has at most one request in flight, so its messages
+    keep their order and a channel stuck on a 429 doesn't hold up the rest.
+
+    Chat relay is the only thing that can fall far behind, so each channel
+    keeps at most max_chat_backlog chat messages. Older ones are dropped and
+    a note of how many were skipped is sent where they would have been.
+    """
+    def __init__(self, client, channel_rate=CHANNEL_RATE, channel_burst=CHANNEL_BURST, global_rate=GLOBAL_RATE,
+                 global_burst=GLOBAL_BURST, max_chat_backlog=20, retry_after=5):
+        self.client = client
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_chat_backlog = max_chat_backlog
+        self.retry_after = retry_after
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = {}
+        # Channel id -> [deque per priority class]
+        self.queues = {}
+        self.dropped = {}
+        self.in_flight = set()
+        self._wakeup = None
+
+    def _channel_key(self, channel):
+        return getattr(channel, "id", channel)
+
+    def _queue(self, entry):
+        key = self._channel_key(entry.channel)
+        queues = self.queues.get(key)
+        if queues is None:
+            queues = self.queues[key] = (deque(), deque(), deque())
+        queue = queues[entry.priority]
+        queue.append(entry)
+        if entry.priority == CHAT and len(queue) > self.max_chat_backlog:
+            queue.popleft()
+            self.dropped[key] = self.dropped.get(key, 0) + 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _submit(self, priority, channel, content=None, embed=None, message=None, wait=True):
+        if channel is None:
+            log.error("Dropping a message for a channel that doesn't exist: {}".format(content))
+            return None
+        future = asyncio.Future() if wait else None
+        self._queue(OutboundMessage(priority, channel, content, embed, message, future))
+        return future
+
+    async def send_message(self, channel, content=None, embed=None, priority=REPLY, wait=True):
+        """Queues a message, returns the sent discord.Message, or None straight away when wait is False"""
+        future = self._submit(priority, channel, content=content, embed=embed, wait=wait)
+        if future is None:
+            return None
+        return await future
+
+    async def edit_message(self, message, content=None, embed=None, priority=REPLY, wait=True):
+        future = self._submit(priority, message.channel, content=content, embed=embed, message=message, wait=wait)
+        if future is None:
+            return None
+        return await future
+
+    async def send_chat(self, channel, content):
+        """Queues chat relay without waiting for it to be sent, for ChatBatcher"""
+        self._submit(CHAT, channel, content=content, wait=False)
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.channel_rate, self.channel_burst)
+        return bucket
+
+    def _next(self, now):
+        """Returns (entry, 0) for the most important sendable message, or (None, seconds to wait)"""
+        wait = None
+        best = None
+        for key, queues in self.queues.items():
+            if key in self.in_flight:
+                continue
+            for queue in queues:
+                if queue:
+                    entry = queue[0]
+                    break
+            else:
+                continue
+            channel_wait = self._bucket(key).wait_time(now)
+            if channel_wait:
+                wait = channel_wait if wait is None else min(wait, channel_wait)
+            elif best is None or (entry.priority, entry.queued) < (best.priority, best.queued):
+                best = entry
+        return best, wait
+
+    def _pop(self, entry):
+        key = self._channel_key(entry.channel)
+        queues = self.queues[key]
+        queues[entry.priority].popleft()
+        if not any(queues):
+            del self.queues[key]
+
+    async def run(self, is_closed=lambda: False):
+        self._wakeup = asyncio.Event()
+        while not is_closed():
+            self._wakeup.clear()
+            now = time.monotonic()
+            entry, wait = self._next(now)
+            if entry is not None:
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait:
+                    await asyncio.sleep(global_wait)
+                    continue
+                self._pop(entry)
+                key = self._channel_key(entry.channel)
+                self.global_bucket.take(now)
+                self._bucket(key).take(now)
+                self.in_flight.add(key)
+                asyncio.ensure_future(self._deliver(key, entry))
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _requeue(self, key, entry):
+        """Puts an entry back at the front of its queue"""
+        queues = self.queues.get(key)
+        if queues is None:
+            queues = self.queues[key] = (deque(), deque(), deque())
+        queues[entry.priority].appendleft(entry)
+
+    def _with_drop_note(self, key, entry):
+        """Returns the chat entry to send, with a note of the messages dropped just before it
+
+        The note goes right where the gap is: in front of the first message
+        after it, or when that message is too full, on its own with the
+        message put back to go next.
+        """
+        dropped = self.dropped.pop(key, 0)
+        if not dropped:
+            return entry
+        note = "*Skipped {} chat message(s) to catch up, see the chat log for them*".format(dropped)
+        if len(note) + 1 + len(entry.content or "") > MAX_MESSAGE_LENGTH:
+            self._requeue(key, entry)
+            return OutboundMessage(CHAT, entry.channel, note)
+        # Kept on the entry, so a retry after a 429 still carries the note
+        entry.content = note + "\n" + (entry.content or "")
+        return entry
+
+    async def _deliver(self, key, entry):
+        try:
+            if entry.priority == CHAT:
+                entry = self._with_drop_note(key, entry)
+            if entry.message is not None:
+                result = await self.client.edit_message(entry.message, entry.content, embed=entry.embed)
+            else:
+                result = await self.client.send_message(entry.channel, entry.content, embed=entry.embed)
+        except Exception as e:
+            response = getattr(e, "response", None)
+            if getattr(response, "status", None) == 429:
+                retry_after = self.retry_after
+                try:
+                    retry_after = float(response.headers.get("Retry-After", retry_after))
+                except (AttributeError, TypeError, ValueError):
+                    pass
+                log.warning("Rate limited sending to {}, retrying in {}s".format(entry.channel, retry_after))
+                self._bucket(key).block(retry_after)
+                self._requeue(key, entry)
+            elif entry.future is not None:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+            else:
+                log.error("Unable to send a message to {}:\n{}".format(entry.channel, traceback.format_exc()))
+        else:
+            if entry.future is not None and not entry.future.done():
+                entry.future.set_result(result)
+        finally:
+            self.in_flight.discard(key)
+            if self._wakeup is not None:
+                self._wakeup.set()
@@ -13,24 +13,94 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import logging
+import random
 import socket
 import struct
+import time
 import traceback
 
-from random import getrandbits
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
+SERVERDATA_RESPONSE_VALUE = 0x00
+SERVERDATA_EXECCOMMAND = 0x02
+SERVERDATA_AUTH = 0x03
+
+# Every packet starts with a little-endian int32 size, followed by the request
+# id and packet type; the size counts everything after itself
+PACKET_SIZE = struct.Struct("<i")
+PACKET_HEADER = struct.Struct("<iii")
+PACKET_ID_TYPE = struct.Struct("<ii")
+# Request id, packet type and the two null terminators
+PACKET_OVERHEAD = 10
+
+
+def build_packet(request_id, packet_type, body):
+    payload = body.encode("utf8")
+    return PACKET_HEADER.pack(len(payload) + PACKET_OVERHEAD, request_id, packet_type) + payload + b"\x00\x00"
+
+
+class RCONPacketFramer(object):
+    """Splits a stream of RCON bytes into packets as they arrive
+
+    Data is appended to a single buffer and headers are unpacked in place, so
+    a packet that arrives over several reads (or several packets in one read)
+    is handled without re-slicing the stream. Only the body is copied out.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def feed(self, data):
+        if self.position:
+            # Drop everything already handed out before growing the buffer
+            del self.buffer[:self.position]
+            self.position = 0
+        self.buffer += data
+
+    def next_packet(self):
+        """Returns (request_id, packet_type, body) or None if the packet is incomplete"""
+        start = self.position
+        available = len(self.buffer) - start
+        if available < PACKET_SIZE.size:
+            return None
+
+        size = PACKET_SIZE.unpack_from(self.buffer, start)[0]
+        if size < PACKET_OVERHEAD:
+            raise ValueError("Invalid RCON packet size: {}".format(size))
+        if available < PACKET_SIZE.size + size:
+            return None
+
+        start += PACKET_SIZE.size
+        request_id, packet_type = PACKET_ID_TYPE.unpack_from(self.buffer, start)
+        with memoryview(self.buffer) as view:
+            body = bytes(view[start + PACKET_ID_TYPE.size:start + size - 2])
+        self.position = start + size
+        return request_id, packet_type, body
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.position = 0
+
 
 class RCONClient(object):
-    def __init__(self, host="", port="", password="", retries=10):
+    def __init__(self, host="", port="", password="", retries=10, multi_packet=False):
         self.host = host
         self.port = port
         self.password = password
         self.retries = retries
+        self.multi_packet = multi_packet
         self.connection = None
         self.is_authenticated = False
+        self.framer = RCONPacketFramer()
+        self._request_id = 0
+
+    def _next_request_id(self):
+        self._request_id = (self._request_id % 0x7fffffff) + 1
+        return self._request_id
 
     def connect(self):
         unknown_log = False
@@ -42,6 +112,8 @@ class RCONClient(object):
                 self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.connection.settimeout(15)
                 self.connection.connect((self.host, self.port))
+                self.framer.reset()
+                self.is_authenticated = False
                 log.debug("Connection established")
                 return True
             except (socket.timeout, ConnectionAbortedError, ConnectionRefusedError):
@@ -76,33 +148,44 @@ class RCONClient(object):
         if self.connection:
             self.connection.close()
 
-    def receive_and_parse_data(self, client_bytes=b"\x00\x00\x00\x00"):
+    def receive_packet(self):
+        packet = self.framer.next_packet()
+        while packet is None:
+            data = self.connection.recv(4096)
+            if not data:
+                raise ConnectionResetError("RCON connection closed by the server")
+            self.framer.feed(data)
+            packet = self.framer.next_packet()
+
+        return packet
+
+    def receive_and_parse_data(self, request_id=0, sentinel_id=None):
+        """Reads packets until the response to request_id is complete
+
+        Returns b"-1" if the server rejected the request (bad password).
+        When a sentinel packet was queued behind the request, bodies are
+        collected until the server echoes it back, otherwise the first
+        matching packet is the full response.
+        """
+        parts = []
         try:
-            data = self.connection.recv(1024*12)
-        except (socket.timeout, ConnectionResetError, ConnectionRefusedError):
+            while True:
+                response_id, _, body = self.receive_packet()
+                if response_id == -1:
+                    return b"-1"
+                if response_id == request_id:
+                    parts.append(body)
+                    if sentinel_id is None:
+                        break
+                elif sentinel_id is not None and response_id == sentinel_id:
+                    break
+                else:
+                    log.debug("Discarding RCON packet for stale request {}".format(response_id))
+        except (socket.timeout, ConnectionResetError, ConnectionRefusedError, ValueError):
             self.disconnect()
             return None
 
-        if len(data) < 12:
-            return None
-
-        idx = 0
-        size = struct.unpack("i", data[idx:idx+4])[0]
-        idx += 4
-        client_id = struct.unpack("4s", data[idx:idx+4])[0]
-        idx += 4
-        _ = struct.unpack("i", data[idx:idx+4])[0]  # Command, not needed for anything currently
-        idx += 4
-        packet_data = struct.unpack("{}s".format(size-10), data[idx:idx+size-10])[0]
-        # TODO: Parse multi-packet, not sure if ARK's RCON service even uses multi-packet though...
-        if not packet_data:
-            pass
-
-        idx += size - 10
-        if client_bytes:
-            if client_id != client_bytes:
-                return b"-1"
-
+        packet_data = b"".join(parts)
         if packet_data:
             return packet_data
 
@@ -114,23 +197,21 @@ class RCONClient(object):
             self.is_authenticated = True
             self.send_command(command=self.password)
 
-        client_id = bytearray(getrandbits(8) for _ in range(4))
-        packet_length = bytearray([12 + len(command) + 2, 00, 00, 00])
-        bytes_command = bytearray(command, "utf8")
-
-        data = bytearray()
-        data += packet_length
-        data += client_id
+        client_id = self._next_request_id()
         if command == self.password:
-            data.append(0x03)
+            data = build_packet(client_id, SERVERDATA_AUTH, command)
         else:
-            data.append(0x02)
-        data += b"\x00\x00\x00"  # Padding for command type
-        data += bytes_command    # The actual command
-        data += b"\x00\x00"      # Termination
+            data = build_packet(client_id, SERVERDATA_EXECCOMMAND, command)
+
+        sentinel_id = None
+        if self.multi_packet and command != self.password:
+            # The server answers an empty SERVERDATA_RESPONSE_VALUE only after it has
+            # finished sending every packet of the previous response
+            sentinel_id = self._next_request_id()
+            data += build_packet(sentinel_id, SERVERDATA_RESPONSE_VALUE, "")
 
         try:
-            self.connection.send(data)
+            self.connection.sendall(data)
             has_exception = False
         except socket.timeout:
             log.error("Socket timeout handled, connection closed")
@@ -146,7 +227,7 @@ class RCONClient(object):
             self.disconnect()
             return None
 
-        resp = self.receive_and_parse_data(client_bytes=client_id)
+        resp = self.receive_and_parse_data(request_id=client_id, sentinel_id=sentinel_id)
         if command == self.password:
             if resp == b"-1":
                 log.error("Bad RCON password specified")
@@ -157,3 +238,352 @@ class RCONClient(object):
             return resp
 
         return None
+
+
+class CircuitBreaker(object):
+    """Stops calls to a server that keeps failing until it looks healthy again
+
+    While closed every call goes through. After failure_threshold consecutive
+    failures the breaker opens and refuses calls for reset_timeout seconds,
+    then lets a single probe through (half open). A successful probe closes
+    the breaker, a failed one re-opens it with the timeout doubled, up to
+    max_reset_timeout.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30, max_reset_timeout=600, name=""):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_timeout = reset_timeout
+        self.opened_at = 0
+        self.probe_started = 0
+
+    def allow_request(self):
+        if self.state == self.CLOSED:
+            return True
+
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.current_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            log.debug("Circuit breaker for {} half open, probing".format(self.name))
+            return True
+
+        # Half open, only one probe at a time unless the last one never reported back
+        if now - self.probe_started >= self.current_timeout:
+            self.probe_started = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            log.info("Circuit breaker for {} closed, server is reachable again".format(self.name))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_timeout = self.reset_timeout
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.current_timeout = min(self.current_timeout * 2, self.max_reset_timeout)
+        elif self.state == self.OPEN or self.failures < self.failure_threshold:
+            return
+
+        if self.state == self.CLOSED:
+            log.warning("Circuit breaker for {} opened after {} failures".format(self.name, self.failures))
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+class AsyncRCONClient(object):
+    """RCON client built on asyncio streams
+
+    Keeps a single authenticated connection open between commands and only
+    reconnects when the connection has dropped, so it can be shared by the
+    bot's background tasks and commands without blocking the event loop.
+
+    With pipelined=True (the default) any number of commands can be in flight
+    on the connection at once. Every request gets the next id from a counter
+    and a reader task hands each response to the caller waiting on that id.
+
+    Connecting retries with jittered exponential backoff, and a CircuitBreaker
+    makes commands to a server that is down return None straight away instead
+    of waiting on connection timeouts every time.
+    """
+    def __init__(self, host="", port="", password="", timeout=15, multi_packet=False, pipelined=True,
+                 connect_timeout=5, connect_retries=3, backoff_base=0.5, backoff_max=10, breaker=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.connect_retries = connect_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker(name="{}:{}".format(host, port))
+        self.multi_packet = multi_packet
+        self.pipelined = pipelined
+        self.reader = None
+        self.writer = None
+        self.is_authenticated = False
+        self.framer = RCONPacketFramer()
+        self.last_received = 0
+        self._request_id = 0
+        # request id -> [future, list of body parts, waiting for a sentinel]
+        self._pending = {}
+        # sentinel id -> request id it terminates
+        self._sentinels = {}
+        self._reader_task = None
+        self._connect_lock = None
+        self._write_lock = None
+        self._request_lock = None
+
+    @property
+    def is_connected(self):
+        return self.writer is not None and self.is_authenticated
+
+    def _next_request_id(self):
+        self._request_id = (self._request_id % 0x7fffffff) + 1
+        return self._request_id
+
+    def _create_locks(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+            self._request_lock = asyncio.Lock()
+
+    async def connect(self):
+        self._create_locks()
+        # A half open breaker only gets a single probe, no retries
+        attempts = self.connect_retries if self.breaker.state == CircuitBreaker.CLOSED else 1
+        for attempt in range(attempts):
+            if attempt:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                log.debug("Retrying connection to {}:{} in {:.2f}s".format(self.host, self.port, delay))
+                await asyncio.sleep(delay)
+            if await self._connect_once():
+                self.breaker.record_success()
+                return True
+
+        log.error("Unable to connect to RCON service at {}:{} after {} attempt(s)".format(
+            self.host, self.port, attempts))
+        self.breaker.record_failure()
+        return False
+
+    async def _connect_once(self):
+        await self.disconnect()
+        log.debug("Starting connection to {}:{}".format(self.host, self.port))
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        except (asyncio.TimeoutError, OSError) as e:
+            log.debug("Connection to {}:{} failed: {!r}".format(self.host, self.port, e))
+            await self.disconnect()
+            return False
+
+        log.debug("Connection established")
+        self.framer.reset()
+        request_id = self._next_request_id()
+        try:
+            await self._write(build_packet(request_id, SERVERDATA_AUTH, self.password))
+            response_id, _, _ = await self._read_packet(self.connect_timeout)
+        except (asyncio.TimeoutError, OSError, ValueError):
+            log.debug("Connection to {}:{} dropped while authenticating".format(self.host, self.port))
+            await self.disconnect()
+            return False
+
+        if response_id == -1:
+            log.error("Bad RCON password specified")
+            await self.disconnect()
+            return False
+
+        log.debug("RCON password accepted")
+        self.is_authenticated = True
+        self._reader_task = asyncio.ensure_future(self._read_responses(self.reader))
+        return True
+
+    async def disconnect(self):
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+        self.is_authenticated = False
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._fail_pending(ConnectionResetError("RCON connection to {}:{} closed".format(self.host, self.port)))
+        if writer:
+            writer.close()
+
+    def _fail_pending(self, exc):
+        pending = self._pending
+        self._pending = {}
+        self._sentinels = {}
+        for future, _, _ in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    async def _write(self, data):
+        async with self._write_lock:
+            writer = self.writer
+            if writer is None:
+                raise ConnectionResetError("RCON connection to {}:{} is closed".format(self.host, self.port))
+            writer.write(data)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+
+    async def _read_packet(self, timeout=None):
+        packet = self.framer.next_packet()
+        while packet is None:
+            data = await asyncio.wait_for(self.reader.read(4096), timeout)
+            if not data:
+                raise ConnectionResetError("RCON connection closed by the server")
+            self.framer.feed(data)
+            self.last_received = time.monotonic()
+            packet = self.framer.next_packet()
+
+        return packet
+
+    async def _read_responses(self, reader):
+        try:
+            while self.reader is reader:
+                response_id, _, body = await self._read_packet()
+                self._dispatch(response_id, body)
+        except asyncio.CancelledError:
+            raise
+        except (OSError, ValueError) as e:
+            if self.reader is reader:
+                log.debug("RCON connection to {}:{} lost: {!r}".format(self.host, self.port, e))
+                self._reader_task = None
+                await self.disconnect()
+
+    def _dispatch(self, response_id, body):
+        entry = self._pending.get(response_id)
+        if entry:
+            future, parts, wait_for_sentinel = entry
+            parts.append(body)
+            if not wait_for_sentinel:
+                self._complete(response_id)
+            return
+
+        request_id = self._sentinels.pop(response_id, None)
+        if request_id is not None:
+            self._complete(request_id)
+            return
+
+        log.debug("Discarding RCON packet for stale request {}".format(response_id))
+
+    def _complete(self, request_id):
+        future, parts, _ = self._pending.pop(request_id)
+        if not future.done():
+            future.set_result(b"".join(parts))
+
+    async def _execute(self, command):
+        request_id = self._next_request_id()
+        data = build_packet(request_id, SERVERDATA_EXECCOMMAND, command)
+        sentinel_id = None
+        if self.multi_packet:
+            sentinel_id = self._next_request_id()
+            data += build_packet(sentinel_id, SERVERDATA_RESPONSE_VALUE, "")
+            self._sentinels[sentinel_id] = request_id
+
+        future = asyncio.Future()
+        self._pending[request_id] = [future, [], sentinel_id is not None]
+        sent_at = time.monotonic()
+        try:
+            await self._write(data)
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # Only tear the connection down if nothing at all came back since
+            # this request was sent, other requests may still be in flight
+            if self.last_received < sent_at:
+                await self.disconnect()
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+            if sentinel_id is not None:
+                self._sentinels.pop(sentinel_id, None)
+
+    async def send_command(self, command=""):
+        self._create_locks()
+        if self.pipelined:
+            return await self._send_command(command)
+
+        async with self._request_lock:
+            return await self._send_command(command)
+
+    async def _send_command(self, command):
+        # A persistent connection can be closed by the server between
+        # commands, so retry once on a fresh connection before giving up
+        for attempt in range(2):
+            if not self.is_connected:
+                if not self.breaker.allow_request():
+                    log.debug("Skipping RCON command to {}:{}, circuit breaker is {}".format(
+                        self.host, self.port, self.breaker.state))
+                    return None
+                failures = self.breaker.failures
+                async with self._connect_lock:
+                    if not self.is_connected:
+                        # Don't pile more attempts on a connect that just failed
+                        if self.breaker.failures != failures or not await self.connect():
+                            return None
+            writer = self.writer
+            try:
+                return await self._execute(command)
+            except asyncio.TimeoutError:
+                log.error("RCON command to {}:{} timed out".format(self.host, self.port))
+                return None
+            except (OSError, ValueError):
+                log.debug("RCON connection to {}:{} lost, reconnecting".format(self.host, self.port))
+                # Another request may already have replaced the connection
+                if self.writer is writer:
+                    await self.disconnect()
+
+        return None
+
+
+class RCONCluster(object):
+    """Runs RCON commands against every server in a cluster at the same time
+
+    clients is a mapping of map name to AsyncRCONClient. broadcast() returns a
+    report keyed by map name, in the same order as the clients, of the form:
+
+        {"ok": bool, "response": bytes or None, "error": str or None, "elapsed": seconds}
+    """
+    def __init__(self, clients=None, timeout=10):
+        self.clients = OrderedDict(clients or {})
+        self.timeout = timeout
+
+    async def _run(self, name, command, timeout):
+        start = time.monotonic()
+        result = {"ok": False, "response": None, "error": None, "elapsed": 0.0}
+        try:
+            resp = await asyncio.wait_for(self.clients[name].send_command(command=command), timeout)
+        except asyncio.TimeoutError:
+            result["error"] = "timed out after {}s".format(timeout)
+        except Exception as e:
+            log.error("Unknown exception sending RCON command to {}:\n{}".format(name, traceback.format_exc()))
+            result["error"] = repr(e)
+        else:
+            if resp is None:
+                result["error"] = "no response"
+            else:
+                result["ok"] = True
+                result["response"] = resp
+
+        result["elapsed"] = time.monotonic() - start
+        return result
+
+    async def broadcast(self, command, timeout=None, names=None):
+        """Sends command to every server (or only those in names) concurrently"""
+        if timeout is None:
+            timeout = self.timeout
+        names = [name for name in (names or self.clients) if name in self.clients]
+        results = await asyncio.gather(*[self._run(name, command, timeout) for name in names])
+        return OrderedDict(zip(names, results))
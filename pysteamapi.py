@@ -13,219 +13,317 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import bz2
 import logging
+import socket
 import struct
+import time
+import zlib
 
-from socket import AF_INET, SOCK_DGRAM, socket
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
+A2S_INFO_REQUEST = b"\xff\xff\xff\xffTSource Engine Query\x00"
+A2S_RULES_REQUEST = b"\xff\xff\xff\xff\x56"
+A2S_PLAYER_REQUEST = b"\xff\xff\xff\xff\x55"
+NO_CHALLENGE = b"\xff\xff\xff\xff"
+SPLIT_PACKET = b"\xfe\xff\xff\xff"
 
-class SteamInfo(object):
-    def __init__(self, host="", port=""):
-        self.connect = (host, port)
-        self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.sock.settimeout(5)
+# Response type byte (after the 0xFFFFFFFF header) for each query
+A2S_INFO_RESPONSE = 0x49
+A2S_RULES_RESPONSE = 0x45
+A2S_PLAYER_RESPONSE = 0x44
+S2C_CHALLENGE = 0x41
 
-    @staticmethod
-    def parse_until_null(data, start_idx):
-        output = ""
-        for char in data[start_idx:]:
-            if char == 0:
-                end_idx = start_idx + len(output) + 1
-                return output, end_idx
-            else:
-                output += chr(char)
 
-    @staticmethod
-    def get_version(data):
-        version = ""
-        for char in data[::-1][1:]:
-            if char == "(":
-                break
-            version += char
+# Fixed-size fields, compiled once. Everything in A2S is little-endian.
+SHORT = struct.Struct("<h")
+LONG_LONG = struct.Struct("<q")
+# App id, players, max players, bots, server type, environment, visibility, VAC
+INFO_FIELDS = struct.Struct("<hBBBBBBB")
+# Score and duration that follow each player's name
+PLAYER_FIELDS = struct.Struct("<if")
+# Split packet header, packet id, total packets, packet number, max packet size
+SPLIT_HEADER = struct.Struct("<iIBBh")
+# Decompressed size and CRC32, only in the first packet of a compressed response
+SPLIT_COMPRESSION = struct.Struct("<iI")
 
-        return version[::-1]
+SERVER_TYPES = {100: "dedicated", 108: "non-dedicated", 112: "proxy"}  # "d", "l", "p"
+SERVER_OS = {108: "linux", 119: "windows", 109: "mac", 111: "mac"}  # "l", "w", "m", "o"
+YES_NO = {1: "yes", 0: "no"}
+BOOLEAN_RULES = ("ALLOWDOWNLOAD", "Networking", "OFFICIAL", "SESSIONIS")
 
-    def get_a2s_info(self):
-        output = {}
-        try:
-            self.sock.sendto(b"\xff\xff\xff\xffTSource Engine Query\x00", self.connect)
-            data = self.sock.recv(1024*12)
-        except socket.timeout:
-            self.sock.close()
-            return output
 
-        if not data[0:5] == b"\xff\xff\xff\xff\x49":
-            log.error("Unexpected A2S_INFO response")
-            return output
-
-        output["protocol"] = data[5]
-        idx = 6
-        sname, idx = self.parse_until_null(data, idx)
-        sversion = self.get_version(sname)
-        verlen = (len(sversion) + 5) * -1
-        output["server_name"] = sname[:verlen]
-        output["server_version"] = sversion
-        output["server_map"], idx = self.parse_until_null(data, idx)
-        output["server_folder"], idx = self.parse_until_null(data, idx)
-        output["server_game"], idx = self.parse_until_null(data, idx)
-        output["steam_id"] = str(struct.unpack("h", data[idx:idx + 2])[0])
-        idx += 2
-        players = data[idx]
-        total_players = data[idx + 1]
-        output["players"] = "{}/{}".format(players, total_players)
-        idx += 2
-        output["bots"] = str(data[idx])
-        idx += 1
-        server_type = data[idx]
-        if server_type == 100:  # "d"
-            output["server_type"] = "dedicated"
-        elif server_type == 108:  # "l"
-            output["server_type"] = "non-dedicated"
-        elif server_type == 112:  # "p"
-            output["server_type"] = "proxy"
-        else:
-            output["server_type"] = "unknown"
-        idx += 1
-        environment = data[idx]
-        if environment == 108:  # "l"
-            output["server_os"] = "linux"
-        elif environment == 119:  # "w"
-            output["server_os"] = "windows"
-        elif environment in [109, 111]:  # "m" or "o"
-            output["server_os"] = "mac"
-        else:
-            output["server_os"] = "unknown"
-        idx += 1
-        visible = data[idx]
-        if visible == 1:
-            output["password"] = "yes"
-        elif visible == 0:
-            output["password"] = "no"
-        else:
-            output["password"] = "unknown"
-        idx += 1
-        vac = data[idx]
-        if vac == 1:
-            output["vac_enforced"] = "yes"
-        elif vac == 0:
-            output["vac_enforced"] = "no"
+def parse_until_null(data, start_idx, view=None):
+    """Returns the UTF-8 string starting at start_idx and the index after its terminator
+
+    The terminator is found with bytes.index and the string decoded straight
+    from a memoryview slice, so no intermediate copies are made. Raises
+    ValueError if the string is not terminated.
+    """
+    if view is None:
+        view = memoryview(data)
+    end_idx = data.index(b"\x00", start_idx)
+    return str(view[start_idx:end_idx], "utf8", "replace"), end_idx + 1
+
+
+def get_version(data):
+    # Server names end with " - (v357.4)"
+    return data[data.rfind("(") + 1:-1]
+
+
+def parse_a2s_info(data):
+    if not data[0:5] == b"\xff\xff\xff\xff\x49":
+        return None
+
+    view = memoryview(data)
+    output = {}
+    output["protocol"] = data[5]
+    idx = 6
+    sname, idx = parse_until_null(data, idx, view)
+    sversion = get_version(sname)
+    verlen = (len(sversion) + 5) * -1
+    output["server_name"] = sname[:verlen]
+    output["server_version"] = sversion
+    output["server_map"], idx = parse_until_null(data, idx, view)
+    output["server_folder"], idx = parse_until_null(data, idx, view)
+    output["server_game"], idx = parse_until_null(data, idx, view)
+    steam_id, players, total_players, bots, server_type, environment, visible, vac = INFO_FIELDS.unpack_from(data, idx)
+    idx += INFO_FIELDS.size
+    output["steam_id"] = str(steam_id)
+    output["players"] = "{}/{}".format(players, total_players)
+    output["bots"] = str(bots)
+    output["server_type"] = SERVER_TYPES.get(server_type, "unknown")
+    output["server_os"] = SERVER_OS.get(environment, "unknown")
+    output["password"] = YES_NO.get(visible, "unknown")
+    output["vac_enforced"] = YES_NO.get(vac, "unknown")
+    output["game_version"], idx = parse_until_null(data, idx, view)
+    edf = data[idx]
+    idx += 1
+    if edf & 0x80:
+        output["server_game_port"] = str(SHORT.unpack_from(data, idx)[0])
+        idx += SHORT.size
+    else:
+        output["server_game_port"] = "none"
+    if edf & 0x10:
+        output["server_steam_id"] = str(LONG_LONG.unpack_from(data, idx)[0])
+        idx += LONG_LONG.size
+    else:
+        output["server_steam_id"] = "none"
+    if edf & 0x40:
+        port = SHORT.unpack_from(data, idx)[0]
+        idx += SHORT.size
+        proxy_name, idx = parse_until_null(data, idx, view)
+        output["sourcetv"] = {"proxy_name": proxy_name, "port": port}
+    else:
+        output["sourcetv"] = {}
+    if edf & 0x20:
+        future_use, idx = parse_until_null(data, idx, view)
+        output["future_use"] = repr(future_use)
+    else:
+        output["future_use"] = "none"
+    if edf & 0x01:
+        output["game_id"] = str(LONG_LONG.unpack_from(data, idx)[0])
+        idx += LONG_LONG.size
+    else:
+        output["game_id"] = "none"
+
+    return output
+
+
+def parse_a2s_rules(data):
+    if not (len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x45"):
+        return None
+
+    view = memoryview(data)
+    idx = 5
+    rules_count = SHORT.unpack_from(data, idx)[0]
+    idx += SHORT.size
+    rules = {}
+    for item in range(rules_count):
+        rule_name, idx = parse_until_null(data, idx, view)
+        rule_value, idx = parse_until_null(data, idx, view)
+        if rule_name.startswith("MOD"):
+            mod_id, _, mod_hash = rule_value.partition(":")
+            rules[rule_name] = {"mod_id": mod_id, "mod_hash": mod_hash}
+        elif rule_name.startswith(BOOLEAN_RULES):
+            if rule_value == "0":
+                rule_value = "false"
+            elif rule_value == "1":
+                rule_value = "true"
+            rules[rule_name] = rule_value
         else:
-            output["vac_enforced"] = "unknown"
+            rules[rule_name] = rule_value
+
+    return rules
+
+
+def parse_a2s_players(data):
+    if not (len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x44"):
+        return None
+
+    view = memoryview(data)
+    idx = 5
+    player_count = data[idx]
+    idx += 1
+    players = []
+    for item in range(player_count):
+        player_index = data[idx]
         idx += 1
-        edf = data[idx]
-        if edf & 0x80:
-            output["server_game_port"] = str(struct.unpack("h", data[idx:idx + 2])[0])
-            idx += 2
-        else:
-            output["server_game_port"] = "none"
-        if edf & 0x10:
-            output["server_steam_id"] = str(struct.unpack("q", data[idx:idx + 8])[0])
-            idx += 8
-        else:
-            output["server_steam_id"] = "none"
-        if edf & 0x40:
-            port = struct.unpack("h", data[idx:idx + 2])[0]
-            idx += 2
-            proxy_name, idx = self.parse_until_null(data, idx)
-            output["sourcetv"] = {"proxy_name": proxy_name, "port": port}
-        else:
-            output["sourcetv"] = {}
-        if edf & 0x20:
-            future_use, idx = self.parse_until_null(data, idx)
-            output["future_use"] = repr(future_use)
-        else:
-            output["future_use"] = "none"
-        if edf & 0x01:
-            output["game_id"] = str(struct.unpack("q", data[idx:idx + 8])[0])
-            idx += 8
-        else:
-            output["game_id"] = "none"
+        player_name, idx = parse_until_null(data, idx, view)
+        score, duration = PLAYER_FIELDS.unpack_from(data, idx)
+        idx += PLAYER_FIELDS.size
+        players.append({
+            "index": player_index,
+            "player_name": player_name,
+            "score": score,
+            "duration": duration
+        })
+    return players
 
-        return output
 
-    def get_a2s_rules(self):
-        try:
-            self.sock.sendto(b"\xff\xff\xff\xff\x56\x00\x00\x00\x00", self.connect)
-            data = self.sock.recv(1024*12)
-        except socket.timeout:
-            self.sock.close()
-            return {}
+class SplitPacketAssembler(object):
+    """Reassembles A2S responses the server split over several datagrams
 
-        if len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x41":
-            knock_resp = b"\xff\xff\xff\xff\x56" + data[-4:]
-            self.sock.sendto(knock_resp, self.connect)
-            data = self.sock.recv(1024 * 12)
-            if len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x45":
-                idx = 5
-                rules_count = struct.unpack("h", data[idx:idx + 2])[0]
-                idx += 2
-                rules = {}
-                for item in range(rules_count):
-                    rule_name, idx = self.parse_until_null(data, idx)
-                    rule_value, idx = self.parse_until_null(data, idx)
-                    if rule_name.startswith("MOD"):
-                        mod_id, mod_hash = rule_value.split(":")
-                        rules[rule_name] = {"mod_id": mod_id, "mod_hash": mod_hash}
-                    elif rule_name.startswith(("ALLOWDOWNLOAD", "Networking", "OFFICIAL", "SESSIONIS")):
-                        if rule_value == "0":
-                            rule_value = "false"
-                        elif rule_value == "1":
-                            rule_value = "true"
-                        rules[rule_name] = rule_value
-                    else:
-                        rules[rule_name] = rule_value
-
-                return rules
+    Fragments are keyed by sender address and packet id and may arrive in any
+    order. At most max_pending responses are buffered at once (the oldest is
+    dropped when a new one starts) and fragments of a response that isn't
+    complete within expiry seconds are thrown away.
+    """
+    def __init__(self, max_pending=32, max_packets=32, expiry=5):
+        self.max_pending = max_pending
+        self.max_packets = max_packets
+        self.expiry = expiry
+        # (addr, packet id) -> [time first seen, total packets, {packet number: payload}]
+        self._pending = OrderedDict()
 
-            else:
-                log.error("Unexpected A2S_RULES response")
-        else:
-            log.error("Unexpected A2S_RULES knock")
+    def __len__(self):
+        return len(self._pending)
 
-        return {}
+    def _expire(self, now):
+        while self._pending:
+            key, entry = next(iter(self._pending.items()))
+            if now - entry[0] < self.expiry and len(self._pending) <= self.max_pending:
+                break
+            log.debug("Dropping incomplete split A2S response {} from {}".format(key[1], key[0]))
+            del self._pending[key]
 
-    def get_a2s_players(self):
+    def add(self, data, addr=None):
+        """Adds one 0xFFFFFFFE datagram, returns the full response once every part has arrived"""
+        try:
+            _, packet_id, total, number, _ = SPLIT_HEADER.unpack_from(data)
+        except struct.error:
+            log.debug("Truncated split A2S packet from {}".format(addr))
+            return None
+        if not total or number >= total or total > self.max_packets:
+            log.debug("Invalid split A2S packet {}/{} from {}".format(number, total, addr))
+            return None
+
+        now = time.monotonic()
+        key = (addr, packet_id)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [now, total, {}]
+            self._expire(now)
+        entry[2][number] = data[SPLIT_HEADER.size:]
+        if len(entry[2]) < entry[1]:
+            return None
+
+        del self._pending[key]
+        parts = entry[2]
+        payload = b"".join(parts[idx] for idx in range(entry[1]))
+        if packet_id & 0x80000000:
+            return self._decompress(payload, addr)
+        return payload
+
+    @staticmethod
+    def _decompress(payload, addr):
+        size, crc = SPLIT_COMPRESSION.unpack_from(payload)
         try:
-            self.sock.sendto(b"\xff\xff\xff\xff\x55\xff\xff\xff\xff", self.connect)
+            payload = bz2.decompress(payload[SPLIT_COMPRESSION.size:])
+        except (OSError, ValueError):
+            log.error("Unable to decompress split A2S response from {}".format(addr))
+            return None
+        if len(payload) != size or zlib.crc32(payload) & 0xffffffff != crc:
+            log.error("Split A2S response from {} failed its checksum".format(addr))
+            return None
+        return payload
+
+
+class SteamInfo(object):
+    parse_until_null = staticmethod(parse_until_null)
+    get_version = staticmethod(get_version)
+
+    def __init__(self, host="", port=""):
+        self.connect = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(5)
+        self.challenge = None
+        self.assembler = SplitPacketAssembler()
+
+    def _recv(self):
+        data = self.sock.recv(1024*12)
+        while data[0:4] == SPLIT_PACKET:
+            payload = self.assembler.add(data, self.connect)
+            if payload is not None:
+                return payload
             data = self.sock.recv(1024*12)
+        return data
+
+    def get_a2s_info(self):
+        try:
+            self.sock.sendto(A2S_INFO_REQUEST, self.connect)
+            data = self._recv()
         except socket.timeout:
             self.sock.close()
             return {}
 
-        if len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x41":
-            knock_resp = b"\xff\xff\xff\xff\x55" + data[-4:]
-            self.sock.sendto(knock_resp, self.connect)
-            data = self.sock.recv(1024 * 12)
-            if len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x44":
-                idx = 5
-                player_count = data[idx]
-                idx += 1
-                players = []
-                for item in range(player_count):
-                    player_index = data[idx]
-                    idx += 1
-                    player_name, idx = self.parse_until_null(data, idx)
-                    score = struct.unpack("i", data[idx:idx + 4])[0]
-                    idx += 4
-                    duration = struct.unpack("f", data[idx:idx + 4])[0]
-                    idx += 4
-                    players.append({
-                        "index": player_index,
-                        "player_name": player_name,
-                        "score": score,
-                        "duration": duration
-                    })
-                return players
+        try:
+            output = parse_a2s_info(data)
+        except (IndexError, struct.error, ValueError):
+            output = None
+        if output is None:
+            log.error("Unexpected A2S_INFO response")
+            return {}
 
-            else:
-                log.error("Unexpected A2S_PLAYER response")
-        else:
-            log.error("Unexpected A2S_PLAYER knock")
+        return output
+
+    def _query_with_challenge(self, request, parser, name):
+        # Reuse the last challenge the server gave us, and only fall back to
+        # the knock round trip when it has none or rejects the cached one
+        challenge = self.challenge or NO_CHALLENGE
+        for attempt in range(2):
+            try:
+                self.sock.sendto(request + challenge, self.connect)
+                data = self._recv()
+            except socket.timeout:
+                self.sock.close()
+                return {}
+
+            if len(data) > 5 and data[0:5] == b"\xff\xff\xff\xff\x41":
+                challenge = self.challenge = data[5:9]
+                continue
 
+            try:
+                result = parser(data)
+            except (IndexError, struct.error, ValueError):
+                result = None
+            if result is None:
+                log.error("Unexpected {} response".format(name))
+                return {}
+            return result
+
+        log.error("{} challenge was rejected".format(name))
         return {}
 
+    def get_a2s_rules(self):
+        return self._query_with_challenge(A2S_RULES_REQUEST, parse_a2s_rules, "A2S_RULES")
+
+    def get_a2s_players(self):
+        return self._query_with_challenge(A2S_PLAYER_REQUEST, parse_a2s_players, "A2S_PLAYER")
+
     def get_all_steam_info(self):
         return {
             "A2S_INFO": self.get_a2s_info(),
@@ -238,3 +336,185 @@ class SteamInfo(object):
 
     def close(self):
         self.sock.close()
+
+
+class A2SQueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def datagram_received(self, data, addr):
+        self.engine.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        log.debug("A2S socket error: {!r}".format(exc))
+
+    def connection_lost(self, exc):
+        self.engine.transport = None
+
+
+class SteamQueryEngine(object):
+    """Queries A2S_INFO/RULES/PLAYERS from many servers over one UDP socket
+
+    Every request for every server is sent up front and replies are matched
+    to the waiting query by their source address and response type, so a
+    sweep of the whole cluster takes a single timeout window even when some
+    servers never answer. Concurrent callers asking the same server for the
+    same data share one request. Responses split over several datagrams are
+    reassembled before they are matched.
+
+    Challenge tokens are cached per server and sent with every RULES/PLAYERS
+    query, so the knock round trip only happens on the first query or when
+    the server rejects (re-issues) a token.
+    """
+    KINDS = {
+        "A2S_INFO": A2S_INFO_RESPONSE,
+        "A2S_RULES": A2S_RULES_RESPONSE,
+        "A2S_PLAYERS": A2S_PLAYER_RESPONSE,
+    }
+    PARSERS = {
+        A2S_INFO_RESPONSE: parse_a2s_info,
+        A2S_RULES_RESPONSE: parse_a2s_rules,
+        A2S_PLAYER_RESPONSE: parse_a2s_players,
+    }
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.transport = None
+        self.assembler = SplitPacketAssembler()
+        # (address, response type) -> list of futures waiting on it
+        self._pending = {}
+        # (host, port) as configured -> resolved (ip, port) replies come from
+        self._addresses = {}
+        # Resolved address -> last challenge token the server handed out
+        self.challenges = {}
+        # (address, response type) -> challenges the pending request was re-sent with
+        self._knocks = {}
+
+    async def open(self):
+        if self.transport is None:
+            loop = asyncio.get_event_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: A2SQueryProtocol(self), family=socket.AF_INET)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        if key not in self._addresses:
+            loop = asyncio.get_event_loop()
+            info = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self._addresses[key] = info[0][4][:2]
+        return self._addresses[key]
+
+    def build_request(self, response_type, addr):
+        challenge = self.challenges.get(addr, NO_CHALLENGE)
+        if response_type == A2S_INFO_RESPONSE:
+            return A2S_INFO_REQUEST
+        if response_type == A2S_RULES_RESPONSE:
+            return A2S_RULES_REQUEST + challenge
+        return A2S_PLAYER_REQUEST + challenge
+
+    def datagram_received(self, data, addr):
+        if data[0:4] == SPLIT_PACKET:
+            data = self.assembler.add(data, addr)
+            if data is None:
+                return
+
+        if len(data) < 5 or data[0:4] != b"\xff\xff\xff\xff":
+            log.debug("Ignoring unknown A2S datagram from {}".format(addr))
+            return
+
+        response_type = data[4]
+        if response_type == S2C_CHALLENGE:
+            self.challenge_received(addr, data[5:9])
+            return
+
+        futures = self._pending.pop((addr, response_type), None)
+        self._knocks.pop((addr, response_type), None)
+        if not futures:
+            log.debug("Ignoring unexpected A2S response {:#x} from {}".format(response_type, addr))
+            return
+
+        try:
+            result = self.PARSERS[response_type](data)
+        except (IndexError, struct.error, ValueError):
+            log.error("Malformed A2S response {:#x} from {}".format(response_type, addr))
+            result = None
+
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    def challenge_received(self, addr, challenge):
+        # A server hands out one challenge per client address, answer every
+        # query to it that is still waiting on the knock
+        self.challenges[addr] = challenge
+        for response_type in (A2S_RULES_RESPONSE, A2S_PLAYER_RESPONSE):
+            key = (addr, response_type)
+            if not self._pending.get(key):
+                continue
+            # Skip tokens this request was already re-sent with (the knock for
+            # the other query type returns the same one), and give up after two
+            # different tokens rather than bounce knocks until the timeout
+            used = self._knocks.setdefault(key, [])
+            if challenge in used or len(used) >= 2:
+                continue
+            used.append(challenge)
+            self.transport.sendto(self.build_request(response_type, addr), addr)
+
+    async def query(self, host, port, kinds=("A2S_INFO", "A2S_RULES", "A2S_PLAYERS"), timeout=None):
+        results = await self.query_all([(host, port)], kinds=kinds, timeout=timeout)
+        return results[(host, port)]
+
+    async def query_all(self, servers, kinds=("A2S_INFO", "A2S_RULES", "A2S_PLAYERS"), timeout=None):
+        """Queries every (host, port) in servers at once
+
+        Returns {(host, port): {"A2S_INFO": {...}, "A2S_RULES": {...}, "A2S_PLAYERS": [...]}}
+        with only the requested kinds. Like SteamInfo, anything that did not
+        answer in time (or answered with garbage) comes back as {}.
+        """
+        await self.open()
+        if timeout is None:
+            timeout = self.timeout
+
+        loop = asyncio.get_event_loop()
+        waiting = {}
+        for host, port in servers:
+            try:
+                addr = await self.resolve(host, port)
+            except OSError as e:
+                log.error("Unable to resolve {}:{}: {!r}".format(host, port, e))
+                continue
+
+            for kind in kinds:
+                response_type = self.KINDS[kind]
+                future = loop.create_future()
+                futures = self._pending.setdefault((addr, response_type), [])
+                futures.append(future)
+                if len(futures) == 1:
+                    self.transport.sendto(self.build_request(response_type, addr), addr)
+                waiting[(host, port, kind)] = (addr, response_type, future)
+
+        if waiting:
+            await asyncio.wait([future for _, _, future in waiting.values()], timeout=timeout)
+
+        results = {}
+        for host, port in servers:
+            results[(host, port)] = {kind: {} for kind in kinds}
+
+        for (host, port, kind), (addr, response_type, future) in waiting.items():
+            if future.done() and future.result() is not None:
+                results[(host, port)][kind] = future.result()
+            else:
+                future.cancel()
+                futures = self._pending.get((addr, response_type))
+                if futures and future in futures:
+                    futures.remove(future)
+                    if not futures:
+                        del self._pending[(addr, response_type)]
+                        self._knocks.pop((addr, response_type), None)
+
+        return results
@@ -0,0 +1,150 @@
+# Copyright (C) 2017 ArkAgainstHumanity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+import traceback
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class ServerSnapshotService(object):
+    """Keeps the latest A2S data for every map in memory
+
+    A background task (run()) sweeps the whole cluster every interval seconds
+    with a SteamQueryEngine. Commands read the cached snapshots and only go
+    to the network when a snapshot is older than max_age, so the load on the
+    game servers doesn't grow with the number of people typing commands.
+
+    A snapshot is a dict of:
+
+        {"A2S_INFO": {...}, "A2S_RULES": {...}, "A2S_PLAYERS": [...],
+         "players_known": bool, "online": bool,
+         "updated": unix time of the last sweep,
+         "last_seen": unix time the server last answered or None}
+
+    players_known is False when the A2S_PLAYERS query got no answer, so a
+    lost reply can be told apart from an empty server. A2S_PLAYERS then
+    keeps the previous list while the server is online, [] otherwise.
+
+    A2S_RULES rarely changes, so it is only re-queried every rules_interval
+    seconds. Functions in listeners are called with {name: snapshot} for the
+    maps refreshed after every sweep.
+    """
+    def __init__(self, engine, servers, interval=30, max_age=90, rules_interval=600):
+        self.engine = engine
+        # Map name -> (host, query port)
+        self.servers = OrderedDict(servers)
+        self.interval = interval
+        self.max_age = max_age
+        self.rules_interval = rules_interval
+        self.snapshots = {}
+        self._checked = {}
+        self._rules_checked = {}
+        self._refreshing = None
+        self.listeners = []
+
+    def get(self, name):
+        return self.snapshots.get(name)
+
+    def age(self, name):
+        checked = self._checked.get(name)
+        if checked is None:
+            return None
+        return time.monotonic() - checked
+
+    def is_fresh(self, name, max_age=None):
+        age = self.age(name)
+        return age is not None and age <= (self.max_age if max_age is None else max_age)
+
+    async def get_fresh(self, names=None, max_age=None):
+        """Returns {name: snapshot}, querying live only the maps whose snapshot is stale"""
+        names = list(names or self.servers)
+        stale = [name for name in names if not self.is_fresh(name, max_age)]
+        if stale:
+            await self.refresh(stale)
+        return OrderedDict((name, self.snapshots.get(name)) for name in names)
+
+    async def refresh(self, names=None):
+        # Coalesce overlapping refreshes, callers arriving mid-sweep wait on it. Several callers
+        # can be waiting on the same sweep, so once it's done join whichever one of them starts
+        # the next sweep instead of each starting its own
+        names = list(names or self.servers)
+        while self._refreshing is not None and not self._refreshing.done():
+            await asyncio.shield(self._refreshing)
+            names = [name for name in names if not self.is_fresh(name)]
+            if not names:
+                return
+        self._refreshing = asyncio.ensure_future(self._refresh(names))
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh(self, names):
+        now = time.monotonic()
+        with_rules = [name for name in names if now - self._rules_checked.get(name, -self.rules_interval) >=
+                      self.rules_interval]
+        without_rules = [name for name in names if name not in with_rules]
+        queries = []
+        if with_rules:
+            queries.append(self.engine.query_all([self.servers[name] for name in with_rules],
+                                                 kinds=("A2S_INFO", "A2S_RULES", "A2S_PLAYERS")))
+        if without_rules:
+            queries.append(self.engine.query_all([self.servers[name] for name in without_rules],
+                                                 kinds=("A2S_INFO", "A2S_PLAYERS")))
+        results = {}
+        for result in await asyncio.gather(*queries):
+            results.update(result)
+
+        updated = time.time()
+        refreshed = OrderedDict()
+        for name in names:
+            result = results.get(self.servers[name], {})
+            previous = self.snapshots.get(name) or {}
+            online = bool(result.get("A2S_INFO"))
+            # query_all gives {} for a query that wasn't answered, a list when it was (even if empty)
+            players = result.get("A2S_PLAYERS")
+            players_known = isinstance(players, list)
+            if not players_known:
+                players = previous.get("A2S_PLAYERS", []) if online else []
+            snapshot = {
+                "A2S_INFO": result.get("A2S_INFO") or {},
+                "A2S_PLAYERS": players,
+                "players_known": players_known,
+                "A2S_RULES": result.get("A2S_RULES") or previous.get("A2S_RULES", {}),
+                "online": online,
+                "updated": updated,
+                "last_seen": updated if online else previous.get("last_seen"),
+            }
+            if name in with_rules and result.get("A2S_RULES"):
+                self._rules_checked[name] = now
+            self.snapshots[name] = snapshot
+            self._checked[name] = now
+            refreshed[name] = snapshot
+
+        for listener in self.listeners:
+            try:
+                listener(refreshed)
+            except Exception:
+                log.error("Server snapshot listener failed:\n{}".format(traceback.format_exc()))
+
+    async def run(self, is_closed=lambda: False):
+        while not is_closed():
+            try:
+                await self.refresh()
+            except Exception:
+                log.error("Unable to refresh the server snapshots:\n{}".format(traceback.format_exc()))
+            await asyncio.sleep(self.interval)